@@ -0,0 +1,116 @@
+'''
+Karma calculation on a synthetic guild of 100 users and 50 finished rounds: the per-roll path bot.py used to have,
+two queries per watcher and proposer of every roll, against Bot.calc_karma, which reads the round's karma at once and
+writes it in one batch. Every round is calculated in its own unit of work, as end_round does.
+
+    python benchmarks/bench_karma.py [users] [rounds]
+'''
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import Bot
+from db import connect, Db, Guild, User
+from migrate import migrate
+
+INIT_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'init.sql')
+HISTORY = 'SELECT user_id, karma, time FROM karma_history ORDER BY user_id, time'
+
+async def build_guild(db, num_users, num_rounds):
+    '''Every participant watches the title of another participant each round, scores are random.'''
+    rng = random.Random(0)
+    start = datetime(2020, 1, 1)
+    async with db.transaction():
+        guild = await Guild.fetch_or_insert(db, 1)
+        challenge = await guild.add_challenge('bench', start)
+        await challenge.add_pool('main')
+        pool = await challenge.fetch_pool('main')
+        participants = []
+        for i in range(num_users):
+            user = await User.fetch_or_insert(db, 1000 + i, f'user{i}')
+            participants.append(await challenge.add_participant(user.id))
+        for p in participants:
+            await pool.add_titles(p.id, [(f'{p.id}-{r}', None) for r in range(num_rounds)])
+        titles = {}
+        for t in await pool.fetch_titles():
+            titles[t.name] = t.id
+
+        rounds = []
+        for r in range(num_rounds):
+            finish = start + timedelta(days=r + 1)
+            round = await challenge.add_round(r, finish - timedelta(days=1), finish)
+            shift = r % (num_users - 1) + 1
+            await round.add_rolls([(p.id, titles[f'{participants[(i + shift) % num_users].id}-{r}'])
+                for i, p in enumerate(participants)])
+            for roll in await round.fetch_rolls():
+                roll.score = rng.randint(1, 10)
+                await roll.update()
+            round.is_finished = True
+            await round.update()
+            rounds.append(round)
+    return rounds
+
+async def fetch_user_karma(db, user_id):
+    row = await db.fetchrow('SELECT karma FROM karma_history WHERE user_id = ? ORDER BY time DESC LIMIT 1', [user_id])
+    return None if row is None else row[0]
+
+async def insert_or_update_karma(db, user_id, karma, time):
+    row = await db.fetchrow('SELECT karma FROM karma_history WHERE user_id = ? AND time = ?', [user_id, time])
+    if row is None:
+        await db.execute('INSERT INTO karma_history (user_id, karma, time) VALUES (?, ?, ?)', [user_id, karma, time])
+    else:
+        await db.execute('UPDATE karma_history SET karma = ? WHERE user_id = ? AND time = ?', [karma, user_id, time])
+
+async def legacy_calc_karma(db, round):
+    for roll in await round.fetch_rolls():
+        proposer = (await db.fetchrow('''
+            SELECT P.user_id FROM title T
+            JOIN participant P ON P.id = T.participant_id
+            WHERE T.id = ?''', [roll.title_id]))[0]
+        watcher = (await db.fetchrow('SELECT user_id FROM participant WHERE id = ?', [roll.participant_id]))[0]
+        score = roll.score
+        if score is not None and watcher != proposer:
+            for user_id, d_karma in ((proposer, score), (watcher, score if score < 5 else 5 + (score - 5) * 0.25)):
+                karma = await fetch_user_karma(db, user_id)
+                await insert_or_update_karma(db, user_id, (karma or 0) + d_karma, round.finish_time)
+
+async def bench(db, rounds, calc):
+    await db.execute('DELETE FROM karma_history')
+    start = time.perf_counter()
+    for round in rounds:
+        async with db.transaction():
+            await calc(round)
+    return time.perf_counter() - start
+
+async def main(num_users=100, num_rounds=50):
+    with tempfile.TemporaryDirectory() as tmp:
+        connection = await connect(os.path.join(tmp, 'bench.db'), {})
+        try:
+            with open(INIT_SQL, 'r') as f:
+                await connection.executescript(f.read())
+            await migrate(connection)
+            db = Db(connection)
+            rounds = await build_guild(db, num_users, num_rounds)
+            bot = types.SimpleNamespace(db=db)
+
+            legacy = await bench(db, rounds, lambda round: legacy_calc_karma(db, round))
+            legacy_history = await db.fetchall(HISTORY)
+            batched = await bench(db, rounds, lambda round: Bot.calc_karma(bot, round))
+            assert await db.fetchall(HISTORY) == legacy_history, 'the two paths disagree'
+        finally:
+            await connection.close()
+
+    print(f'{num_users} users, {num_rounds} rounds')
+    print(f'{"per roll (legacy)":<20} {legacy * 1000:8.0f} ms {legacy / num_rounds * 1000:8.2f} ms/round')
+    print(f'{"batched":<20} {batched * 1000:8.0f} ms {batched / num_rounds * 1000:8.2f} ms/round')
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:3])))
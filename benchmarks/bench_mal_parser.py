@@ -0,0 +1,86 @@
+'''
+MyAnimeList page parsing: the whole-document regexes mal_api.py used to have against mal_parser, which only looks at
+the <head> and the left sidebar. Runs over a directory of saved anime pages, or over a synthetic page of about the
+size of a real one when no directory is given.
+
+    python benchmarks/bench_mal_parser.py [directory of saved .html pages]
+'''
+import glob
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thirdparty_api.mal_api import length_str_to_minutes, mal_parser
+
+NUMBER = 20
+
+def legacy_mal_parser(html):
+    name = re.search(r'\<meta property=\"og:title\" content=\"(.*?)\"\>', html)[1]
+    score = re.search(r'.*?score\-label.*?\>(\d+?\.\d+?)\<.*?', html)[1]
+    num_of_episodes = re.search(r'pisodes\:</span>.*?(\d+).*?\<', html, flags=re.DOTALL)[1]
+    length_str = re.search(r'Duration\:</span>.*?\"(.*?)\".*?\<', html, flags=re.DOTALL)[1]
+    length = length_str_to_minutes(length_str)
+    if length == 0:
+        length = 20
+    return {'name': name, 'score': float(score), 'num_of_episodes': int(num_of_episodes), 'length': length}
+
+def synthetic_page():
+    body = '\n'.join(f'<div class="comment" id="c{i}"><a href="/profile/u{i}">user {i}</a> '
+        f'<span class="score">{i % 10}</span> {"lorem ipsum dolor sit amet " * 8}</div>' for i in range(2000))
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<title>Cowboy Bebop - MyAnimeList.net</title>
+<meta property="og:title" content="Cowboy Bebop">
+<script type="application/ld+json">{{"@type": "TVSeries", "name": "Cowboy Bebop", "numberOfEpisodes": 26,
+"aggregateRating": {{"ratingValue": "8.75"}}}}</script>
+</head>
+<body>
+<div class="leftside">
+<div class="spaceit_pad"><span class="dark_text">Episodes:</span>
+  26
+</div>
+<div class="spaceit_pad"><span class="dark_text">Duration:</span>
+  <span title="24 min. per ep.">24 min. per ep.</span>
+</div>
+<div class="spaceit_pad"><span class="dark_text">Score:</span>
+  <span class="score-label score-8">8.75</span>
+</div>
+</div>
+<div class="rightside">
+{body}
+</div>
+</body>
+</html>'''
+
+def load_pages(directory):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+def safe(parser, page):
+    try:
+        return parser(page)
+    except (TypeError, ValueError):
+        return None
+
+def run(name, parser, pages):
+    failed = sum(safe(parser, page) is None for page in pages)
+    t = min(timeit.repeat(lambda: [safe(parser, page) for page in pages], number=NUMBER, repeat=3))
+    print(f'{name:<12} {t / NUMBER / len(pages) * 1e6:10.0f} us/page {failed:6} failed')
+
+def main():
+    pages = load_pages(sys.argv[1]) if len(sys.argv) > 1 else [synthetic_page()]
+    if not pages:
+        sys.exit(f'No .html pages in {sys.argv[1]}.')
+    print(f'{len(pages)} pages, {sum(map(len, pages)) // len(pages)} bytes on average')
+    run('legacy', legacy_mal_parser, pages)
+    run('mal_parser', mal_parser, pages)
+
+if __name__ == '__main__':
+    main()
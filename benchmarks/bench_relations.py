@@ -0,0 +1,67 @@
+'''
+Microbenchmark of relation construction and attribute access: the dict/__getattr__ relation db.py used to have
+against the __slots__ classes generated by RelationMeta.
+
+    python benchmarks/bench_relations.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Cols, Title
+
+ROW = [1, 2, 3, 'Title name', 'https://example.com', False]
+NUMBER = 200000
+
+class LegacyRelation(object):
+    def __init__(self, db, name, all_cols, where_cols, row):
+        object.__setattr__(self, 'db', db)
+        assert len(all_cols) == len(row)
+        object.__setattr__(self, 'cols', { col: val for col, val in zip(all_cols, row) })
+
+        async def update():
+            pass
+
+        async def delete():
+            pass
+
+        object.__setattr__(self, 'update', update)
+        object.__setattr__(self, 'delete', delete)
+
+    def check_col(self, col):
+        if col not in self.cols:
+            raise AttributeError(f'Column "{col}" not found in "{self.__class__.__name__}" relation.')
+
+    def __getattr__(self, attr):
+        self.check_col(attr)
+        return self.cols[attr]
+
+    def __setattr__(self, attr, val):
+        self.check_col(attr)
+        self.cols[attr] = val
+
+class LegacyTitle(LegacyRelation):
+    COLS = Cols('id', 'pool_id', 'participant_id', 'name', 'url', 'is_used')
+
+    def __init__(self, db, row):
+        super().__init__(db, 'title', LegacyTitle.COLS, Cols('id'), row)
+
+def run(name, stmt, setup_globals):
+    t = min(timeit.repeat(stmt, number=NUMBER, repeat=5, globals=setup_globals))
+    print(f'{name:<40} {t / NUMBER * 1e9:8.0f} ns')
+
+def main():
+    legacy = LegacyTitle(None, ROW)
+    slotted = Title(None, ROW)
+    env = { 'LegacyTitle': LegacyTitle, 'Title': Title, 'ROW': ROW, 'legacy': legacy, 'slotted': slotted }
+    run('construct (legacy)', 'LegacyTitle(None, ROW)', env)
+    run('construct (slots)', 'Title(None, ROW)', env)
+    run('read 3 attributes (legacy)', 'legacy.name; legacy.is_used; legacy.pool_id', env)
+    run('read 3 attributes (slots)', 'slotted.name; slotted.is_used; slotted.pool_id', env)
+    run('write attribute (legacy)', 'legacy.is_used = True', env)
+    run('write attribute (slots)', 'slotted.is_used = True', env)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Write-heavy throughput under SQLite's defaults (rollback journal, synchronous=FULL, 2 MB cache, no mmap), as the bot
+opened the database before, against the PRAGMAS profile of db.connect(). Every unit of work scores one roll the way
+!rate does: fetch the round and the roll, update the score, commit. It runs alone, then next to read-only connections
+that keep reading the rolls, as the reader pool does while commands are being served.
+
+    python benchmarks/bench_write_throughput.py [units] [directory for the database files]
+'''
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_karma import build_guild, INIT_SQL
+from db import connect, Db
+from migrate import migrate
+
+DEFAULTS = {
+    'sqlite_journal_mode': 'DELETE',
+    'sqlite_synchronous': 'FULL',
+    'sqlite_cache_size': -2000,
+    'sqlite_mmap_size': 0,
+    'sqlite_temp_store': 'DEFAULT',
+    'sqlite_foreign_keys': 'OFF',
+    'sqlite_cached_statements': 128,
+}
+
+NUM_READERS = 2
+
+async def read_rolls(reader, done):
+    num_reads = 0
+    while not done.is_set():
+        async with reader.execute('SELECT round_id, participant_id, score FROM roll') as cursor:
+            await cursor.fetchall()
+        num_reads += 1
+    return num_reads
+
+async def bench(path, config, num_units, num_readers):
+    connection = await connect(path, config)
+    readers = []
+    try:
+        with open(INIT_SQL, 'r') as f:
+            await connection.executescript(f.read())
+        await migrate(connection)
+        db = Db(connection)
+        rounds = await build_guild(db, 20, 5)
+        rolls = [(round, roll.participant_id) for round in rounds for roll in await round.fetch_rolls()]
+        readers = [await connect(path, config, read_only=True) for _ in range(num_readers)]
+        done = asyncio.Event()
+        reads = [asyncio.ensure_future(read_rolls(reader, done)) for reader in readers]
+
+        start = time.perf_counter()
+        for i in range(num_units):
+            round, participant_id = rolls[i % len(rolls)]
+            async with db.transaction():
+                roll = await round.fetch_roll(participant_id)
+                roll.score = i % 10 + 1
+                await roll.update()
+        elapsed = time.perf_counter() - start
+        done.set()
+        return elapsed, sum(await asyncio.gather(*reads))
+    finally:
+        for reader in readers:
+            await reader.close()
+        await connection.close()
+
+async def main(num_units=2000, directory=None):
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for num_readers in (0, NUM_READERS):
+            for name, config in (('defaults', DEFAULTS), ('PRAGMAS', {})):
+                t, num_reads = await bench(os.path.join(tmp, f'{name}-{num_readers}.db'), config, num_units, num_readers)
+                print(f'{name:<10} {num_readers} readers {num_units / t:10.0f} units/s {t / num_units * 1e6:10.0f} us/unit '
+                    f'{num_reads / t:10.0f} reads/s')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    asyncio.run(main(int(args[0]) if args else 2000, args[1] if len(args) > 1 else None))
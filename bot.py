@@ -1,50 +1,61 @@
 import cogs
+import karma as karma_engine
 import os
 import traceback
 import random
 import asyncio
-import aiosqlite
-import sqlite3
+import aiohttp
 import json
-import matplotlib.pyplot as plt
 
-from discord import File
 from discord.ext import commands
 from datetime import datetime, timedelta
 from cogs import BotErr
-from db import Db, Guild, Challenge, Pool, User, Participant, Title, Roll, KarmaHistory, UserStats
-from export import export
+from db import connect, Db, Guild, Challenge, Pool, User, Participant, Title, Roll, KarmaHistory, UserStats, GuildStats, TitleInfo, update_many
+from export import SheetsExporter
+from html_profile.renderer import Renderer
+from html_profile.cache import ImageCache
+from migrate import migrate
+from state_cache import StateCache
+from sync_scheduler import SyncScheduler
 from thirdparty_api.api_title_info import ApiTitleInfo
-from utils import gen_fname
+from thirdparty_api.http_client import HttpError, client as http_client
+from utils import is_vaild_url
+from karma_graph import KarmaGraphRenderer
+from metrics import metrics
 
 class State:
     @staticmethod
     async def fetch(bot, ctx, allow_started=False):
-        guild = await Guild.fetch_or_insert(bot.db, ctx.message.guild.id)
-        cc = await guild.fetch_current_challenge()
+        entry = bot.state_cache.guild_entry(ctx.message.guild.id)
+        guild = await bot.fetch_guild(ctx)
+        cc = await bot.state_cache.lookup(entry, 'cc', guild.fetch_current_challenge)
         BotErr.raise_if(cc is None, 'Create a new challenge first.')
-        BotErr.raise_if(cc is not None and not allow_started and await cc.has_started(),
+        BotErr.raise_if(cc is not None and not allow_started
+            and await bot.state_cache.lookup(entry, 'has_started', cc.has_started),
             'Cannot add/delete user/title/pool after a challenge has started.')
-        return State(bot, guild, cc)
+        return State(bot, guild, cc, entry)
 
-    def __init__(self, bot, guild, cc):
+    def __init__(self, bot, guild, cc, entry):
         self.bot = bot
         self.guild = guild
         self.cc = cc
+        self.entry = entry
 
     async def fetch_user(self, user):
-        return await User.fetch_or_insert(self.bot.db, user.id, user.name)
+        return await self.bot.fetch_user_relation(user)
 
-    async def fetch_participant(self, user):
+    async def _fetch_participant(self, user):
         u = await self.fetch_user(user)
-        p = await self.cc.fetch_participant(u.id)
+        return await self.bot.state_cache.lookup(self.entry['participants'], user.id, lambda: self.cc.fetch_participant(u.id))
+
+    async def fetch_participant(self, user):
+        p = await self._fetch_participant(user)
         BotErr.raise_if(p is None, f'User {user.mention} is not participating in this challenge.')
         BotErr.raise_if(p.has_failed(), f'User {user.mention} has failed this challenge.')
         return p
 
     async def has_participant(self, user):
-        u = await self.fetch_user(user)
-        return await self.cc.has_participant(u.id)
+        return await self._fetch_participant(user) is not None
 
     async def fetch_pool(self, name):
         p = await self.cc.fetch_pool(name)
@@ -61,8 +72,11 @@ class State:
         # BotErr.raise_if(t is None, f'fetch_titles')
         return t
 
+    async def _fetch_last_round(self):
+        return await self.bot.state_cache.lookup(self.entry, 'last_round', self.cc.fetch_last_round)
+
     async def fetch_last_round(self, allow_past_deadline=False):
-        lr = await self.cc.fetch_last_round()
+        lr = await self._fetch_last_round()
         BotErr.raise_if(lr is None, 'Create a new round first.')
         BotErr.raise_if(lr is not None and (lr.is_finished
             or not allow_past_deadline and datetime.now() > lr.finish_time), 'Round has ended.')
@@ -76,11 +90,31 @@ class Bot(commands.Bot):
         self.add_cog(cogs.User(self))
         self.db = db
         self.config = config
+        self.guild_stats_lock = asyncio.Lock()
+        self.state_cache = StateCache()
+        self.karma_graph_renderer = KarmaGraphRenderer(config.get('karma_graph_workers', 1))
+        self.exporter = SheetsExporter(config.get('sync_workers', 4))
+        self.sync_scheduler = SyncScheduler(self.export_challenge, config.get('sync_delay', 5))
+        self.renderer = Renderer(config.get('render_workers', 2), config.get('render_queue_timeout', 30))
+        self.profile_cache = ImageCache(config.get('profile_cache_dir', 'profile_cache'),
+            config.get('profile_cache_memory_mb', 32) * 2**20, config.get('profile_cache_disk_mb', 256) * 2**20)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        with metrics.timer('command_seconds', command=ctx.command.qualified_name):
+            await super().invoke(ctx)
 
     async def on_command_error(self, ctx, e):
         cmd = self.get_command(ctx.message.content.lstrip()[1:])
         help = '' if cmd is None else cmd.help
+        if ctx.command is not None:
+            metrics.inc('command_errors_total', command=ctx.command.qualified_name,
+                error=type(getattr(e, 'original', e)).__name__)
         if isinstance(e, commands.CommandInvokeError):
+            if ctx.guild is not None:
+                # the transaction was rolled back, but cached relations may have been modified before that
+                self.state_cache.invalidate(ctx.guild.id)
             if isinstance(e.original, BotErr):
                 await ctx.send(f'{e.original}\nUsage:\n{help}')
             else:
@@ -90,173 +124,257 @@ class Bot(commands.Bot):
         else:
             await ctx.send(f'{e}\nUsage:\n{help}')
 
-    def get_api_title_info(self, url):
-        return ApiTitleInfo.from_url(url, self.config)
+    async def get_api_title_info(self, url, cache_rows=None):
+        # with cache_rows the fetched info is collected there for the caller to store in its own unit of work
+        async def store(row):
+            if cache_rows is None:
+                await TitleInfo.store(self.db, row)
+            else:
+                cache_rows.append(row)
+
+        key = ApiTitleInfo.provider_id(url)
+        if key is None:
+            return None
+        now = datetime.now()
+        cached = await TitleInfo.fetch(self.db, *key)
+        if cached is not None:
+            ttl = self.config.get('title_info_negative_ttl_minutes', 10) if cached.error is not None \
+                else self.config.get('title_info_ttl_minutes', 7 * 24 * 60)
+            if now - cached.fetch_time < timedelta(minutes=ttl):
+                BotErr.raise_if(cached.error is not None, f'Failed to fetch title info: {cached.error}')
+                return ApiTitleInfo(cached.name, cached.score, cached.length, cached.complexity)
+
+        try:
+            info = await ApiTitleInfo.from_url(url, self.config)
+        except (HttpError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as e:
+            # a missing title or a page that doesn't parse fails the same way again, a timeout or an overloaded
+            # provider may not, so only the former are cached
+            transient = isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)) \
+                or isinstance(e, HttpError) and e.status not in (404, 410)
+            if not transient:
+                await store([*key, None, None, None, None, str(e) or e.__class__.__name__, now])
+            raise BotErr(f'Failed to fetch title info: {e}')
+        await store([*key, info.name, info.score, info.length, info.complexity, None, now])
+        return info
+
+    async def fetch_guild(self, ctx):
+        guild_id = ctx.message.guild.id
+        async def fetch():
+            # the guild may be inserted by the current unit of work, its id must not outlive a rollback
+            self.db.on_rollback(lambda: self.state_cache.invalidate(guild_id))
+            return await Guild.fetch_or_insert(self.db, guild_id)
+        return await self.state_cache.lookup(self.state_cache.guild_entry(guild_id), 'guild', fetch)
+
+    async def fetch_user_relation(self, user):
+        async def fetch():
+            self.db.on_rollback(lambda: self.state_cache.invalidate_user(user.id))
+            return await User.fetch_or_insert(self.db, user.id, user.name)
+        return await self.state_cache.lookup(self.state_cache.users, user.id, fetch)
 
     async def current_titles(self, ctx):
         state = await State.fetch(self, ctx, allow_started=True)
         return await state.fetch_titles()
 
     async def start_challenge(self, ctx, name):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        if guild.current_challenge_id is not None:
-            raise BotErr(f'Finish "{(await guild.fetch_current_challenge()).name}" challenge first.')
-        BotErr.raise_if(await guild.has_challenge(name), f'Challenge "{name}" already exists.')
-        challenge = await guild.add_challenge(name, datetime.now())
-        await challenge.add_pool('main')
-        guild.current_challenge_id = challenge.id
-        await guild.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            guild = await self.fetch_guild(ctx)
+            if guild.current_challenge_id is not None:
+                raise BotErr(f'Finish "{(await guild.fetch_current_challenge()).name}" challenge first.')
+            BotErr.raise_if(await guild.has_challenge(name), f'Challenge "{name}" already exists.')
+            challenge = await guild.add_challenge(name, datetime.now())
+            await challenge.add_pool('main')
+            guild.current_challenge_id = challenge.id
+            await guild.update()
+        self.state_cache.invalidate(guild.discord_id)
 
     async def end_challenge(self, ctx):
-        state = await State.fetch(self, ctx, allow_started=True)
-        lr = await state.cc.fetch_last_round()
-        if lr is not None and not lr.is_finished:
-            await self._end_round(lr)
-        state.cc.finish_time = datetime.now()
-        await state.cc.update()
-        state.guild.current_challenge_id = None
-        await state.guild.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            lr = await state._fetch_last_round()
+            if lr is not None and not lr.is_finished:
+                await self._end_round(lr)
+            state.cc.finish_time = datetime.now()
+            await state.cc.update()
+            state.guild.current_challenge_id = None
+            await state.guild.update()
+        self.state_cache.invalidate(state.guild.discord_id)
+        self.schedule_guild_stats(state.guild.id)
         return state.cc
 
     async def add_pool(self, ctx, name):
-        state = await State.fetch(self, ctx)
-        BotErr.raise_if(await state.cc.has_pool(name), f'Pool "{name}" already exists.')
-        await state.cc.add_pool(name)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            BotErr.raise_if(await state.cc.has_pool(name), f'Pool "{name}" already exists.')
+            await state.cc.add_pool(name)
 
     async def remove_pool(self, ctx, name):
-        state = await State.fetch(self, ctx)
-        await (await state.fetch_pool(name)).delete()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            await (await state.fetch_pool(name)).delete()
 
     async def rename_pool(self, ctx, old_name, new_name):
-        state = await State.fetch(self, ctx, allow_started=True)
-        BotErr.raise_if(await state.cc.has_pool(new_name), f'Pool "{new_name}" already exists.')
-        pool = await state.fetch_pool(old_name)
-        pool.name = new_name
-        await pool.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            BotErr.raise_if(await state.cc.has_pool(new_name), f'Pool "{new_name}" already exists.')
+            pool = await state.fetch_pool(old_name)
+            pool.name = new_name
+            await pool.update()
 
     async def add_user(self, ctx, user):
-        state = await State.fetch(self, ctx)
-        BotErr.raise_if(await state.has_participant(user),
-            f'User {user.mention} is already participating in this challenge.')
-        user = await state.fetch_user(user)
-        await state.cc.add_participant(user.id)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            BotErr.raise_if(await state.has_participant(user),
+                f'User {user.mention} is already participating in this challenge.')
+            u = await state.fetch_user(user)
+            await state.cc.add_participant(u.id)
+        state.entry['participants'].pop(user.id, None)
 
     async def remove_user(self, ctx, user):
-        state = await State.fetch(self, ctx, allow_started=True)
-        participant = await state.fetch_participant(user)
-        last_round = await state.cc.fetch_last_round()
-        if last_round is not None:
-            participant.failed_round_id = last_round.id
-            await participant.update()
-        else:
-            await participant.delete()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            participant = await state.fetch_participant(user)
+            last_round = await state._fetch_last_round()
+            if last_round is not None:
+                participant.failed_round_id = last_round.id
+                await participant.update()
+            else:
+                await participant.delete()
+                state.entry['participants'].pop(user.id, None)
 
     async def add_title(self, ctx, pool, user, name, url):
-        state = await State.fetch(self, ctx)
-        BotErr.raise_if(await state.cc.has_title(name), f'Title "{name}" already exists.')
-        participant = await state.fetch_participant(user)
-        pool = await state.fetch_pool(pool)
-        await pool.add_title(participant.id, name, url)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            BotErr.raise_if(await state.cc.has_title(name), f'Title "{name}" already exists.')
+            participant = await state.fetch_participant(user)
+            pool = await state.fetch_pool(pool)
+            await pool.add_title(participant.id, name, url)
+
+    async def import_titles(self, ctx, pool, user, lines):
+        # resolve metadata before taking the write lock, lookups can take seconds
+        await State.fetch(self, ctx)
+        fan_out = asyncio.Semaphore(self.config.get('import_concurrency', 4))
+        cache_rows = []
+
+        async def resolve(line):
+            if not is_vaild_url(line):
+                return line, None
+            async with fan_out:
+                info = await self.get_api_title_info(line, cache_rows)
+            BotErr.raise_if(info is None, 'Unsupported title url.')
+            return info.name, line
+
+        results = await asyncio.gather(*map(resolve, lines), return_exceptions=True)
+        failed = [(line, r) for line, r in zip(lines, results) if isinstance(r, Exception)]
+        for line, e in failed:
+            if not isinstance(e, BotErr):
+                raise e
+
+        async with self.db.transaction():
+            await TitleInfo.store_many(self.db, cache_rows)
+            state = await State.fetch(self, ctx)
+            participant = await state.fetch_participant(user)
+            pool = await state.fetch_pool(pool)
+            existing = await state.cc.fetch_title_names()
+            new_titles = {}
+            for r in results:
+                if not isinstance(r, Exception) and r[0] not in existing:
+                    new_titles.setdefault(r[0], r)
+            await pool.add_titles(participant.id, new_titles.values())
+        return list(new_titles), len(lines) - len(failed) - len(new_titles), failed
 
     async def remove_title(self, ctx, name):
-        state = await State.fetch(self, ctx)
-        title = await state.fetch_title(name)
-        BotErr.raise_if(title.is_used, "Cannot delete title that's already been used.")
-        await title.delete()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            title = await state.fetch_title(name)
+            BotErr.raise_if(title.is_used, "Cannot delete title that's already been used.")
+            await title.delete()
 
     async def rename_title(self, ctx, old_name, new_name):
-        state = await State.fetch(self, ctx)
-        BotErr.raise_if(await state.cc.has_title(new_name), f'Title "{new_name}" already exists.')
-        title = await state.fetch_title(old_name)
-        title.name = new_name
-        await title.update()
-        await self.db.commit()
-
-    async def start_round(self, ctx, days, pool):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.cc.fetch_last_round()
-        if last_round is not None and not last_round.is_finished:
-            raise BotErr(f'Finish round {last_round.num} first.')
-
-        pool = await state.fetch_pool(pool)
-        users_participants = await state.cc.fetch_users_participants()
-        users = { up[0].id: up[0] for up in users_participants }
-        participants = [up[1] for up in filter(lambda up: not up[1].has_failed(), users_participants)]
-        BotErr.raise_if(len(participants) == 0, 'Not enough participants to start a round.')
-        titles = await pool.fetch_unused_titles()
-        BotErr.raise_if(len(titles) < len(participants), f'Not enough titles in "{pool}" pool.')
-
-        num = last_round.num + 1 if last_round is not None else 0
-        start = datetime.now()
-        new_round = await state.cc.add_round(num, start, start + timedelta(days=days))
-
-        rand_titles = [ titles.pop(random.randrange(len(titles))) for _ in range(len(participants)) ]
-        for participant, title in zip(participants, rand_titles):
-            await new_round.add_roll(participant.id, title.id)
-            participant.progress_current = None
-            participant.progress_total = None
-            title.is_used = True
-            await participant.update()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx)
+            BotErr.raise_if(await state.cc.has_title(new_name), f'Title "{new_name}" already exists.')
+            title = await state.fetch_title(old_name)
+            title.name = new_name
             await title.update()
 
-        await self.db.commit()
+    async def start_round(self, ctx, days, pool):
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state._fetch_last_round()
+            if last_round is not None and not last_round.is_finished:
+                raise BotErr(f'Finish round {last_round.num} first.')
+
+            pool = await state.fetch_pool(pool)
+            users_participants = await state.cc.fetch_users_participants()
+            users = { up[0].id: up[0] for up in users_participants }
+            participants = [up[1] for up in filter(lambda up: not up[1].has_failed(), users_participants)]
+            BotErr.raise_if(len(participants) == 0, 'Not enough participants to start a round.')
+            titles = await pool.fetch_unused_titles()
+            BotErr.raise_if(len(titles) < len(participants), f'Not enough titles in "{pool}" pool.')
+
+            num = last_round.num + 1 if last_round is not None else 0
+            start = datetime.now()
+            new_round = await state.cc.add_round(num, start, start + timedelta(days=days))
+
+            rand_titles = random.sample(titles, len(participants))
+            await new_round.add_rolls([(p.id, t.id) for p, t in zip(participants, rand_titles)])
+            for participant, title in zip(participants, rand_titles):
+                participant.progress_current = None
+                participant.progress_total = None
+                title.is_used = True
+            await update_many(participants)
+            await update_many(rand_titles)
+
+        self.state_cache.invalidate(state.guild.discord_id)
         return new_round, { users[p.user_id].name: t.name for p, t in zip(participants, rand_titles) }
 
-    async def calc_karma(self, round):
+    async def calc_karma(self, round, rolls_watchers_proposers=None):
         if not round.is_finished:
             return
-        starting_karma = 0
-
-        rolls = await round.fetch_rolls()
-        time = round.finish_time
-        for roll in rolls:
-            proposer = await roll.fetch_title_author()
-            watcher = await roll.fetch_participant()
-
-            score = roll.score
-            if score is not None and watcher.id != proposer.id:
-                proposer_karma = await KarmaHistory.fetch_user_karma(self.db, proposer.id)
-                d_karma = score
-
-                if not proposer_karma:
-                    proposer_karma = starting_karma + d_karma
-                else:
-                    proposer_karma += d_karma
-                await KarmaHistory.insert_or_update_karma(self.db, proposer.id, proposer_karma, time)
-
-                watcher_karma = await KarmaHistory.fetch_user_karma(self.db, watcher.id)
-                d_karma = score if score < 5 else 5 + (score - 5) * 0.25
-
-                if not watcher_karma:
-                    watcher_karma = starting_karma + d_karma
-                else:
-                    watcher_karma += d_karma
-                await KarmaHistory.insert_or_update_karma(self.db, watcher.id, watcher_karma, time)
-
-    # def calculate_karma_diff
-    
-    async def recalc_karma(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        users = await guild.fetch_users()
-        for u in users:
-            await KarmaHistory.clear_user_karma_history(self.db, u.id)
 
-        challenges = await guild.fetch_challenges()
-        for c in challenges:
-            rounds = await c.fetch_rounds()
-            for r in rounds:
-                await self.calc_karma(r)
-        
-        await self.db.commit()
+        rwp = rolls_watchers_proposers
+        if rwp is None:
+            rwp = await round.fetch_rolls_watchers_proposers()
+        user_ids = { u.id for _, watcher, proposer in rwp for u in (watcher, proposer) }
+        karma = await KarmaHistory.fetch_users_karma(self.db, user_ids, round.finish_time)
+        changed = karma_engine.apply_round(karma, rwp)
+        await KarmaHistory.set_users_karma(self.db, { id: karma[id] for id in changed }, round.finish_time)
+
+    async def recalc_karma(self, ctx, round_num=None):
+        '''
+        Replays karma of the guild, optionally from a round of the current challenge onward. The replay runs in memory
+        and the whole history is rewritten in one unit of work, so neither a failure nor a concurrent !end_round ever
+        sees it half done.
+        '''
+        async with self.db.transaction():
+            guild = await self.fetch_guild(ctx)
+            from_time = None
+            if round_num is not None:
+                state = await State.fetch(self, ctx, allow_started=True)
+                from_round = await state.cc.fetch_round(round_num)
+                BotErr.raise_if(from_round is None, f'Round {round_num} does not exist.')
+                from_time = from_round.finish_time
+
+            rows = await guild.fetch_karma_rolls(from_time)
+            karma = {}
+            if from_time is not None:
+                user_ids = { id for row in rows for id in row[2:4] }
+                karma = await KarmaHistory.fetch_users_karma(self.db, user_ids, from_time)
+
+            history = []
+            changed = set()
+            num_rounds = 0
+            for i, (round_id, time, watcher_id, proposer_id, score) in enumerate(rows):
+                changed.update(karma_engine.apply_roll(karma, watcher_id, proposer_id, score))
+                if i + 1 < len(rows) and rows[i + 1][0] == round_id:
+                    continue
+                history.extend((id, karma[id], time) for id in changed)
+                changed = set()
+                num_rounds += 1
+
+            await KarmaHistory.clear_guild_karma_history(self.db, guild.id, from_time)
+            await KarmaHistory.insert_karma_many(self.db, history)
+        return num_rounds
 
     async def _end_round(self, last_round):
         rwp = await last_round.fetch_rolls_watchers_proposers()
@@ -265,46 +383,71 @@ class Bot(commands.Bot):
         last_round.is_finished = True
         await last_round.update()
 
-        await self.calc_karma(last_round)
+        await self.calc_karma(last_round, rwp)
 
     async def end_round(self, ctx):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round(allow_past_deadline=True)
-        await self._end_round(last_round)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round(allow_past_deadline=True)
+            await self._end_round(last_round)
+        # failed participants were updated in bulk
+        self.state_cache.invalidate_participants(state.guild.discord_id)
+        self.schedule_guild_stats(state.guild.id)
         return last_round
 
+    def schedule_guild_stats(self, guild_id):
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                e = task.exception()
+                print(f'Stats update of guild {guild_id} failed:')
+                traceback.print_tb(e.__traceback__)
+                print(f'{e.__class__.__name__}: {e}')
+        self.loop.create_task(self.update_guild_stats(guild_id)).add_done_callback(done)
+
+    async def update_guild_stats(self, guild_id):
+        async with self.guild_stats_lock, self.db.transaction():
+            await GuildStats.update(self.db, guild_id)
+
+    async def leaderboard(self, ctx, kind):
+        BotErr.raise_if(kind not in GuildStats.LEADERBOARDS,
+            f'Unknown leaderboard "{kind}". Use one of: {", ".join(GuildStats.LEADERBOARDS)}.')
+        guild = await self.fetch_guild(ctx)
+        # rounds and challenges are folded in when they finish, the write lock is only needed if one was missed
+        if any(await GuildStats.fetch_pending(self.db, guild.id)):
+            await self.update_guild_stats(guild.id)
+        return await GuildStats.fetch_leaderboard(self.db, guild.id, kind)
+
     async def extend_round(self, ctx, days):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round(allow_past_deadline=True)
-        last_round.finish_time += timedelta(days=days)
-        await last_round.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round(allow_past_deadline=True)
+            last_round.finish_time += timedelta(days=days)
+            await last_round.update()
         return last_round
 
     async def rate(self, ctx, user, score):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round()
-        participant = await state.fetch_participant(user)
-        roll = await last_round.fetch_roll(participant.id)
-        roll.score = score
-        await roll.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round()
+            participant = await state.fetch_participant(user)
+            roll = await last_round.fetch_roll(participant.id)
+            roll.score = score
+            await roll.update()
         return await roll.fetch_title()
 
     async def swap(self, ctx, user1, user2):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round()
-        participant1 = await state.fetch_participant(user1)
-        participant2 = await state.fetch_participant(user2)
-        roll1 = await last_round.fetch_roll(participant1.id)
-        roll2 = await last_round.fetch_roll(participant2.id)
-        tmp = roll1.title_id
-        roll1.title_id = roll2.title_id
-        roll2.title_id = tmp
-        await roll1.update()
-        await roll2.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round()
+            participant1 = await state.fetch_participant(user1)
+            participant2 = await state.fetch_participant(user2)
+            roll1 = await last_round.fetch_roll(participant1.id)
+            roll2 = await last_round.fetch_roll(participant2.id)
+            tmp = roll1.title_id
+            roll1.title_id = roll2.title_id
+            roll2.title_id = tmp
+            await roll1.update()
+            await roll2.update()
         return await roll2.fetch_title(), await roll1.fetch_title()
 
     async def _set_title(self, roll, new_title):
@@ -318,64 +461,70 @@ class Bot(commands.Bot):
         await new_title.update()
 
     async def reroll(self, ctx, user, pool):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round()
-        participant = await state.fetch_participant(user)
-        roll = await last_round.fetch_roll(participant.id)
-        pool = await state.fetch_pool(pool)
-        titles = await pool.fetch_unused_titles()
-        BotErr.raise_if(len(titles) == 0, f'Not enough titles in "{pool}" pool.')
-        new_title = random.choice(titles)
-        await self._set_title(roll, new_title)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round()
+            participant = await state.fetch_participant(user)
+            roll = await last_round.fetch_roll(participant.id)
+            pool = await state.fetch_pool(pool)
+            titles = await pool.fetch_unused_titles()
+            BotErr.raise_if(len(titles) == 0, f'Not enough titles in "{pool}" pool.')
+            new_title = random.choice(titles)
+            await self._set_title(roll, new_title)
         return new_title
 
     async def set_title(self, ctx, user, title):
-        state = await State.fetch(self, ctx, allow_started=True)
-        last_round = await state.fetch_last_round()
-        participant = await state.fetch_participant(user)
-        roll = await last_round.fetch_roll(participant.id)
-        new_title = await state.fetch_title(title)
-        await self._set_title(roll, new_title)
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            last_round = await state.fetch_last_round()
+            participant = await state.fetch_participant(user)
+            roll = await last_round.fetch_roll(participant.id)
+            new_title = await state.fetch_title(title)
+            await self._set_title(roll, new_title)
 
     async def karma_table(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        users = [ (user, await KarmaHistory.fetch_user_karma(self.db, user.id)) for user in await guild.fetch_users() ]
-        users = sorted(users, key=lambda x: x[1], reverse=True)
-        return [(u[0].name, '{:.1f}'.format(u[1])) for u in users]
+        guild = await self.fetch_guild(ctx)
+        return [(u.name, '{:.1f}'.format(karma)) for u, karma in await guild.fetch_users_karma()]
 
     async def user_profile(self, ctx, user):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        user = await User.fetch_or_insert(self.db, user.id, user.name)
+        guild = await self.fetch_guild(ctx)
+        user = await self.fetch_user_relation(user)
         return user, await UserStats.fetch(self.db, user.id, guild.id)
 
+    async def render_profile(self, html_string, css_path):
+        key = ImageCache.key(html_string, css_path)
+        data = self.profile_cache.get(key)
+        if data is None:
+            data = await self.renderer.render(html_string, css_path)
+            self.profile_cache.put(key, data)
+        return data
+
     async def set_name(self, user, name):
-        u = await User.fetch_or_insert(self.db, user.id, user.name)
-        u.name = name
-        await u.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            u = await self.fetch_user_relation(user)
+            u.name = name
+            await u.update()
 
     async def set_color(self, user, color):
-        u = await User.fetch_or_insert(self.db, user.id, user.name)
-        u.color = color
-        await u.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            u = await self.fetch_user_relation(user)
+            u.color = color
+            await u.update()
 
     async def set_progress(self, ctx, user, prog_current, prog_total=None):
-        state = await State.fetch(self, ctx, allow_started=True)
-        participant = await state.fetch_participant(user)
-        participant.progress_current = prog_current
-        participant.progress_total = prog_total
-        await participant.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            participant = await state.fetch_participant(user)
+            participant.progress_current = prog_current
+            participant.progress_total = prog_total
+            await participant.update()
 
     async def add_progress(self, ctx, user, num):
-        state = await State.fetch(self, ctx, allow_started=True)
-        participant = await state.fetch_participant(user)
-        participant.progress_current += num      
-        await participant.update()
-        await self.db.commit()    
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            participant = await state.fetch_participant(user)
+            participant.progress_current += num      
+            await participant.update()
 
     async def progress_table(self, ctx):
         state = await State.fetch(self, ctx, allow_started=True)
@@ -383,75 +532,98 @@ class Bot(commands.Bot):
         return [(up[0].name, up[1].progress_current, up[1].progress_total) for up in users_participants]
 
     async def set_spreadsheet_key(self, ctx, key):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)
-        guild.spreadsheet_key = key
-        await guild.update()
-        await self.db.commit()
+        async with self.db.transaction():
+            guild = await self.fetch_guild(ctx)
+            guild.spreadsheet_key = key
+            await guild.update()
+
+    async def export_challenge(self, spreadsheet_key, challenge_id, full=False):
+        challenge = await Challenge.fetch_current_challenge(self.db, challenge_id)
+        if challenge is not None:
+            await self.exporter.export(spreadsheet_key, challenge, full)
 
-    async def sync(self, ctx):
+    async def sync(self, ctx, force=False):
         state = await State.fetch(self, ctx, allow_started=True)
+        if not force:
+            if state.guild.spreadsheet_key is not None:
+                self.sync_scheduler.schedule(state.guild.spreadsheet_key, state.cc.id)
+            return
         BotErr.raise_if(state.guild.spreadsheet_key is None, 'Spreadsheet key is not set.')
-        await export(state.guild.spreadsheet_key, state.cc)
+        await self.sync_scheduler.flush(state.guild.spreadsheet_key, state.cc.id, full=True)
 
     async def sync_all(self, ctx):
-        guild = await Guild.fetch_or_insert(self.db, ctx.message.guild.id)  # todo: move logic?
+        guild = await self.fetch_guild(ctx)  # todo: move logic?
         challenges = await guild.fetch_challenges()
         BotErr.raise_if(guild.spreadsheet_key is None, 'Spreadsheet key is not set.') # todo: maybe its bad to have single
                                                                                             # spreadsheet_key per guild, maybe
                                                                                             # we need to store it in challange column
         for c in challenges:
-            await export(guild.spreadsheet_key, c)
+            self.sync_scheduler.cancel(guild.spreadsheet_key, c.id)
+        async with self.sync_scheduler.lock(guild.spreadsheet_key):
+            num_changed = await self.exporter.export_all(guild.spreadsheet_key, challenges)
+        return len(challenges), num_changed
 
     async def set_award(self, ctx, url):
-        state = await State.fetch(self, ctx, allow_started=True)
-        await state.cc.set_award(url)
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            await state.cc.set_award(url)
 
     async def add_award(self, ctx, user, url):
-        state = await State.fetch(self, ctx, allow_started=True)
-        user = await state.fetch_user(user)
-        await user.add_award(url, datetime.now())
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            user = await state.fetch_user(user)
+            await user.add_award(url, datetime.now())
 
     async def remove_award(self, ctx, user, url):
-        state = await State.fetch(self, ctx, allow_started=True)
-        user = await state.fetch_user(user)
-        await user.remove_award(url)
+        async with self.db.transaction():
+            state = await State.fetch(self, ctx, allow_started=True)
+            user = await state.fetch_user(user)
+            await user.remove_award(url)
 
     async def karma_graph(self, ctx, users):
         state = await State.fetch(self, ctx, allow_started=True)
-        fig = plt.figure()
-        plt.xticks(rotation=30)
-        for user in users:
-            user = await state.fetch_user(user)
-            history = await KarmaHistory.fetch_karma_history(self.db, user.id)
-            if len(history) == 0:
-                ctx.send(f'{user.name} has no karma history')
-                return
-
-            times = [ entry.time for entry in history ]
-            karmas = [ entry.karma for entry in history ]
-            plt.plot(times, karmas, label = user.name)
-         
-        plt.legend()
-        pic_name = gen_fname('.png')
-        fig.savefig(pic_name, dpi=900, marker='.')
-        await ctx.send(file=File(pic_name))
-        os.remove(pic_name)
-        
+        users = [await state.fetch_user(user) for user in users]
+        user_ids = [u.id for u in users]
+        key = (tuple((u.id, u.name) for u in users), tuple(await KarmaHistory.fetch_karma_version(self.db, user_ids)))
+        data = self.karma_graph_renderer.get(key)
+        if data is not None:
+            return data
+
+        histories = await KarmaHistory.fetch_karma_histories(self.db, user_ids)
+        for u in users:
+            BotErr.raise_if(len(histories[u.id]) == 0, f'{u.name} has no karma history.')
+        series = [(u.name, [x.time for x in histories[u.id]], [x.karma for x in histories[u.id]]) for u in users]
+        return await self.karma_graph_renderer.render(key, series)
+
 async def main():
     config = json.loads(open("config.json", 'rb').read())
     token = config["discord_token"]
     path = 'challenges.db'
     init_db = not os.path.isfile(path)
-    async with aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES) as connection:
-        if init_db:
-            await connection.executescript(open('init.sql', 'r').read())
-            await connection.commit()
-
-        bot = Bot(Db(connection), config)
-        try:
-            await bot.start(token)
-        finally:
-            await bot.logout()
+    connection = await connect(path, config)
+    if init_db:
+        await connection.executescript(open('init.sql', 'r').read())
+        await connection.commit()
+    await migrate(connection)
+
+    readers = [await connect(path, config, read_only=True) for _ in range(config.get('sqlite_readers', 2))]
+    slow_query_ms = config.get('slow_query_ms', 100)
+    db = Db(connection, config.get('check_query_plans', False), readers, config.get('group_commit_ms', 0) / 1000,
+        None if slow_query_ms is None else slow_query_ms / 1000)
+    bot = Bot(db, config)
+    metrics_server = None
+    if config.get('metrics_port') is not None:
+        metrics_server = await metrics.serve(config.get('metrics_host', '127.0.0.1'), config['metrics_port'])
+    if config.get('metrics_file') is not None:
+        asyncio.ensure_future(metrics.write_periodically(config['metrics_file'], config.get('metrics_interval', 60)))
+    try:
+        await bot.start(token)
+    finally:
+        await bot.logout()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await http_client.close()
+        await db.close()
 
 if __name__ == '__main__':
     try:
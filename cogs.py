@@ -1,7 +1,7 @@
 import asyncio
+import io
 import uuid
 import re
-import os
 import random
 import math
 
@@ -10,7 +10,8 @@ from discord.ext import commands
 from discord.ext.commands import UserConverter, CommandError
 from datetime import timedelta
 from html_profile.generator import generate_profile_html
-from html_profile.renderer import render_html_from_string
+from html_profile.renderer import RenderTimeout
+from metrics import metrics
 from utils import is_vaild_url
 
 class BotErr(CommandError):
@@ -137,8 +138,8 @@ class Admin(commands.Cog):
         if 'pool' in kwargs:
             pool = kwargs['pool']
 
-        title_info = self.bot.get_api_title_info(url)
-        print(title_info)
+        title_info = await self.bot.get_api_title_info(url)
+        BotErr.raise_if(title_info is None and 'title' not in kwargs, 'Unsupported title url.')
         if 'title' not in kwargs:
             title = title_info.name
         else:
@@ -148,6 +149,30 @@ class Admin(commands.Cog):
         await ctx.send(f'Title "{title}" has been added to "{pool}" pool.')
         await self.bot.sync(ctx)
 
+    @commands.command()
+    async def import_titles(self, ctx, user: UserConverter):
+        '''
+        !import_titles @user [pool='main'] followed by one title or url per line, or an attached text file
+        [Admin only] Adds many titles for specified user at once
+        '''
+        header, _, body = ctx.message.content.partition('\n')
+        args = header.split()[2:]
+        pool = args[0] if args else 'main'
+        for attachment in ctx.message.attachments:
+            body += '\n' + (await attachment.read()).decode('utf-8')
+        lines = [x.strip() for x in body.splitlines() if x.strip()]
+        if not lines:
+            raise BotErr('No titles to import.')
+
+        added, num_duplicates, failed = await self.bot.import_titles(ctx, pool, user, lines)
+        msg = [f'{len(added)} titles have been added to "{pool}" pool.']
+        if num_duplicates > 0:
+            msg.append(f'{num_duplicates} already existed.')
+        for line, e in failed:
+            msg.append(f'Failed "{line}": {e}')
+        await ctx.send('\n'.join(msg))
+        await self.bot.sync(ctx)
+
     @commands.command()
     async def add_user(self, ctx, user: UserConverter):
         '''
@@ -368,13 +393,59 @@ class Admin(commands.Cog):
         await ctx.send('Done.')
 
     @commands.command()
-    async def recalc_karma(self, ctx):
+    async def recalc_karma(self, ctx, round_num: int = None):
         '''
-        !recalc_karma
-        [Admin only] Recalculates karama for every user in the guild
+        !recalc_karma [round]
+        [Admin only] Recalculates karma for every user in the guild, optionally from a round of the current challenge onward
         '''
-        await self.bot.recalc_karma(ctx)
-        await ctx.send('Done.')
+        msg = await ctx.send('Recalculating karma...')
+        num_rounds = await self.bot.recalc_karma(ctx, round_num)
+        await msg.edit(content=f'Done. Replayed {num_rounds} rounds.')
+
+    @commands.command()
+    async def renderer_stats(self, ctx):
+        '''
+        !renderer_stats
+        [Admin only] Shows profile render latency percentiles
+        '''
+        percentiles = self.bot.renderer.percentiles()
+        if not percentiles:
+            return await ctx.send('Nothing has been rendered yet.')
+        table = table_format([(f'p{p}', f'{t:.2f}s') for p, t in percentiles.items()])
+        await ctx.send(f'```\n{table}\n{len(self.bot.renderer.latencies)} samples```')
+
+    @commands.command()
+    async def cache_stats(self, ctx):
+        '''
+        !cache_stats
+        [Admin only] Shows hit/miss counters of the guild state cache
+        '''
+        cache = self.bot.state_cache
+        total = cache.hits + cache.misses
+        ratio = cache.hits / total * 100 if total else 0
+        table = table_format([('hits', cache.hits), ('misses', cache.misses), ('hit ratio', f'{ratio:.1f}%')])
+        await ctx.send(f'```\n{table}\n{len(cache.guilds)} guilds, {len(cache.users)} users cached```')
+
+    @commands.command()
+    async def metrics(self, ctx):
+        '''
+        !metrics
+        [Admin only] Shows command, query and external call latencies
+        '''
+        def bound(t):
+            return '>30s' if math.isinf(t) else f'<{t * 1000:.0f}ms'
+
+        def rows(name, limit=None):
+            hs = sorted(metrics.histograms_named(name), key=lambda x: x[1].sum, reverse=True)[:limit]
+            return [(' '.join(map(str, labels.values()))[:40], h.count, f'{h.sum / h.count * 1000:.0f}ms',
+                bound(h.quantile(0.5)), bound(h.quantile(0.99))) for labels, h in hs]
+
+        header = [('', 'count', 'avg', 'p50', 'p99')]
+        sections = [('Commands', rows('command_seconds')),
+            ('Queries (top 10 by total time)', rows('query_seconds', 10)),
+            ('External', rows('external_seconds'))]
+        msg = [f'{title}:\n```\n{table_format(header + data)}```' for title, data in sections if data]
+        await ctx.send('\n'.join(msg) if msg else 'Nothing has been measured yet.')
 
 class User(commands.Cog):
     def __init__(self, bot):
@@ -419,6 +490,19 @@ class User(commands.Cog):
         table = table_format(map(lambda x: (str(x[0] + 1) + ')', x[1]), enumerate(await self.bot.karma_table(ctx))))
         await ctx.send(f"```markdown\n{ table }```")
 
+    @commands.command()
+    async def leaderboard(self, ctx, kind: str = 'karma'):
+        '''
+        !leaderboard [karma|given|titles|completion|pairs]
+        Shows a guild leaderboard
+        '''
+        rows = await self.bot.leaderboard(ctx, kind)
+        if len(rows) == 0:
+            return await ctx.send('Nothing to show yet.')
+        fmt = lambda x: f'{x:.1f}' if isinstance(x, float) else x
+        table = table_format(map(lambda x: (str(x[0] + 1) + ')',) + tuple(map(fmt, x[1])), enumerate(rows)))
+        await ctx.send(f"```markdown\n{ table }```")
+
     @commands.command()
     async def profile(self, ctx, user: UserConverter = None):
         '''
@@ -494,10 +578,12 @@ class User(commands.Cog):
         avatar_url = str(user.avatar_url).replace("webp", "png")
         user, stats = await self.bot.user_profile(ctx, user)
         html_string = generate_profile_html(user, stats, avatar_url)
-        pic_name = render_html_from_string(html_string, css_path="./html_profile/styles.css")
-        
-        await ctx.send(file=File(pic_name))
-        os.remove(pic_name)
+        try:
+            data = await self.bot.render_profile(html_string, css_path="./html_profile/styles.css")
+        except RenderTimeout:
+            raise BotErr('Profile renderer is busy, try again later.')
+
+        await ctx.send(file=File(io.BytesIO(data), 'profile.jpg'))
 
     @commands.command()
     async def progress(self, ctx, *args):
@@ -623,9 +709,9 @@ class User(commands.Cog):
     async def sync(self, ctx):
         '''
         !sync
-        Syncs current challenge with google sheets doc
+        Rewrites current challenge in google sheets doc
         '''
-        await self.bot.sync(ctx)
+        await self.bot.sync(ctx, force=True)
         await ctx.send('Done.')
 
     @commands.command()
@@ -634,8 +720,8 @@ class User(commands.Cog):
         !sync_all
         Syncs all guild challenges with google sheets doc
         '''
-        await self.bot.sync_all(ctx)
-        await ctx.send('Done.')
+        num_challenges, num_changed = await self.bot.sync_all(ctx)
+        await ctx.send(f'Done. {num_changed} of {num_challenges} challenges had changes.')
 
     @commands.command()
     async def karma_graph(self, ctx, *args):
@@ -646,5 +732,5 @@ class User(commands.Cog):
         users = [ ctx.message.author ]
         if len(args) > 0:
             users = [ await UserConverter().convert(ctx, a) for a in args ]
-        await self.bot.karma_graph(ctx, users)
-        # await ctx.send('Done.')
\ No newline at end of file
+        data = await self.bot.karma_graph(ctx, users)
+        await ctx.send(file=File(io.BytesIO(data), 'karma.png'))
\ No newline at end of file
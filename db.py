@@ -1,33 +1,268 @@
 import aiosqlite
+import asyncio
+import contextvars
+import re
+import sqlite3
+import time
+import traceback
+from operator import attrgetter
+from collections import namedtuple
+from contextlib import asynccontextmanager
 from datetime import datetime
 from cogs import BotErr
+from metrics import metrics
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 256 * 2**20,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+# the task that owns the open transaction; tasks spawned from inside it inherit the value but are not the owner
+current_transaction = contextvars.ContextVar('current_transaction', default=None)
+# (task, reader connection) of an open Db.read_transaction(), only that task's reads go to the held reader
+current_reader = contextvars.ContextVar('current_reader', default=None)
+
+# "IN (?, ?, ?)" built for a variable number of ids, collapsed so every length shares one metrics label
+PLACEHOLDER_LIST = re.compile(r'\(\?(?:\s*,\s*\?)*\)')
+
+class QueryPlanError(Exception):
+    pass
+
+async def connect(path, config, read_only=False):
+    '''
+    Opens the database and applies PRAGMAS, each of which can be overridden by a "sqlite_<pragma>" config key.
+    Read-only connections skip the pragmas that persist in or write to the database file. The writer runs in
+    autocommit mode, transactions are opened explicitly by Db.transaction().
+    '''
+    connection = await aiosqlite.connect(f'file:{ path }?mode=ro' if read_only else path, uri=read_only,
+        isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=config.get('sqlite_cached_statements', 256))
+    for pragma, default in PRAGMAS.items():
+        if not read_only or pragma not in ('journal_mode', 'foreign_keys'):
+            await connection.execute(f'PRAGMA { pragma } = { config.get("sqlite_" + pragma, default) }')
+    return connection
 
 class Db:
-    def __init__(self, db):
+    '''
+    Wraps the writer connection and an optional pool of read-only connections. Reads go to the pool unless the
+    caller is inside a transaction, in which case they must see its uncommitted changes.
+    '''
+    def __init__(self, db, check_query_plans=False, readers=(), group_commit_delay=0, slow_query_threshold=None):
         self.db = db
+        self.check_query_plans = check_query_plans
+        self.checked_queries = set()
+        self.slow_query_threshold = slow_query_threshold
+        self.query_names = {}
+        self.write_lock = asyncio.Lock()
+        self.group_commit_delay = group_commit_delay
+        self.batch = None
+        self.num_savepoints = 0
+        # callbacks undoing in-memory state that depends on the uncommitted work, see on_rollback()
+        self.rollback_callbacks = []
+        self.readers = asyncio.Queue()
+        for reader in readers:
+            self.readers.put_nowait(reader)
+        self.num_readers = len(readers)
+
+    async def check_query_plan(self, query, params=()):
+        if not self.check_query_plans or query in self.checked_queries:
+            return
+        async with self.db.execute(f'EXPLAIN QUERY PLAN { query }', params) as cursor:
+            plan = [row[-1] for row in await cursor.fetchall()]
+        # "SCAN x USING [COVERING] INDEX" walks an index in order and is fine, a bare "SCAN x" is not
+        # unless x is a subquery or a CTE materialized by the plan itself
+        subqueries = { x.split(' ', 1)[1] for x in plan if re.match(r'^(MATERIALIZE|CO-ROUTINE) ', x) }
+        scans = [x for x in plan if re.match(r'^SCAN (?!\(|CONSTANT ROW)', x) and ' USING ' not in x
+            and x.split(' ')[1] not in subqueries]
+        if scans:
+            raise QueryPlanError(f'Full scan ({ "; ".join(scans) }) in query:\n{ query }')
+        self.checked_queries.add(query)
+
+    def in_transaction(self):
+        return current_transaction.get() is asyncio.current_task()
+
+    def on_rollback(self, callback):
+        '''
+        Calls callback if the unit of work the task is in rolls back, a failed group commit included. Outside a unit
+        of work every statement commits on its own and there is nothing to undo.
+        '''
+        if self.in_transaction():
+            self.rollback_callbacks.append(callback)
+
+    def run_rollback_callbacks(self, start):
+        callbacks = self.rollback_callbacks[start:]
+        del self.rollback_callbacks[start:]
+        for callback in reversed(callbacks):
+            callback()
+
+    @asynccontextmanager
+    async def transaction(self):
+        '''
+        Unit of work: BEGIN IMMEDIATE ... COMMIT, or a savepoint when the task is already inside one. Any exception,
+        BotErr included, rolls the unit back. With a group commit delay, units finishing within the delay share
+        one COMMIT, each isolated by its own savepoint, and return once that COMMIT is done.
+        '''
+        if self.in_transaction():
+            async with self.savepoint():
+                yield
+            return
+        batch = None
+        async with self.write_lock:
+            token = current_transaction.set(asyncio.current_task())
+            try:
+                if self.group_commit_delay:
+                    if self.batch is None:
+                        await self.db.execute('BEGIN IMMEDIATE')
+                        self.batch = asyncio.get_event_loop().create_future()
+                        asyncio.ensure_future(self.commit_batch())
+                    batch = self.batch
+                    async with self.savepoint():
+                        yield
+                else:
+                    await self.db.execute('BEGIN IMMEDIATE')
+                    try:
+                        yield
+                        await self.db.commit()
+                    except BaseException:
+                        await self.db.rollback()
+                        self.run_rollback_callbacks(0)
+                        raise
+                    self.rollback_callbacks.clear()
+            finally:
+                current_transaction.reset(token)
+        if batch is not None:
+            await asyncio.shield(batch)
+
+    @asynccontextmanager
+    async def read_transaction(self):
+        '''
+        Consistent view for a group of reads: they all run on one reader inside BEGIN ... ROLLBACK, so they see the
+        same committed state. Inside a unit of work the reads already do; without readers this opens one.
+        '''
+        if self.in_transaction():
+            yield
+            return
+        if self.num_readers == 0:
+            async with self.transaction():
+                yield
+            return
+        reader = await self.readers.get()
+        token = current_reader.set((asyncio.current_task(), reader))
+        try:
+            await reader.execute('BEGIN')
+            try:
+                yield
+            finally:
+                await reader.rollback()
+        finally:
+            current_reader.reset(token)
+            self.readers.put_nowait(reader)
+
+    @asynccontextmanager
+    async def savepoint(self):
+        self.num_savepoints += 1
+        name = f'sp{ self.num_savepoints }'
+        await self.db.execute(f'SAVEPOINT { name }')
+        # callbacks registered past this point belong to the savepoint, the enclosing unit inherits them on release
+        start = len(self.rollback_callbacks)
+        try:
+            yield
+        except BaseException:
+            await self.db.execute(f'ROLLBACK TO { name }')
+            await self.db.execute(f'RELEASE { name }')
+            self.run_rollback_callbacks(start)
+            raise
+        await self.db.execute(f'RELEASE { name }')
+
+    async def commit_batch(self):
+        await asyncio.sleep(self.group_commit_delay)
+        async with self.write_lock:
+            batch, self.batch = self.batch, None
+            try:
+                await self.db.commit()
+            except Exception as e:
+                await self.db.rollback()
+                self.run_rollback_callbacks(0)
+                print('Group commit failed:')
+                traceback.print_tb(e.__traceback__)
+                print(f'{e.__class__.__name__}: {e}')
+                batch.set_exception(e)
+                # units that rolled back or were cancelled do not wait for the batch, retrieve the exception so a
+                # batch nobody awaits does not report it again when garbage collected
+                batch.exception()
+            else:
+                self.rollback_callbacks.clear()
+                batch.set_result(None)
+
+    def record(self, query, start, rows):
+        elapsed = time.monotonic() - start
+        name = self.query_names.get(query)
+        if name is None:
+            name = self.query_names[query] = PLACEHOLDER_LIST.sub('(?, ...)', ' '.join(query.split()))
+        metrics.observe('query_seconds', elapsed, query=name)
+        metrics.inc('query_rows_total', rows, query=name)
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            print(f'Slow query ({ elapsed * 1000:.0f} ms, { rows } rows): { name }')
+
+    async def fetch(self, fetch, *args):
+        await self.check_query_plan(*args)
+        held = current_reader.get()
+        if self.num_readers == 0 or self.in_transaction():
+            start = time.monotonic()
+            async with self.db.execute(*args) as cursor:
+                result = await fetch(cursor)
+        elif held is not None and held[0] is asyncio.current_task():
+            start = time.monotonic()
+            async with held[1].execute(*args) as cursor:
+                result = await fetch(cursor)
+        else:
+            reader = await self.readers.get()
+            try:
+                start = time.monotonic()
+                async with reader.execute(*args) as cursor:
+                    result = await fetch(cursor)
+            finally:
+                self.readers.put_nowait(reader)
+        self.record(args[0], start, len(result) if isinstance(result, list) else int(result is not None))
+        return result
+
+    async def close(self):
+        for _ in range(self.num_readers):
+            await (await self.readers.get()).close()
+        await self.db.close()
 
     async def execute(self, *args):
-        return await self.db.execute(*args)
+        if not self.in_transaction():
+            async with self.transaction():
+                return await self.execute(*args)
+        await self.check_query_plan(*args)
+        start = time.monotonic()
+        cursor = await self.db.execute(*args)
+        self.record(args[0], start, max(cursor.rowcount, 0))
+        return cursor
 
     async def executemany(self, *args):
-        return await self.db.executemany(*args)
+        if not self.in_transaction():
+            async with self.transaction():
+                return await self.executemany(*args)
+        start = time.monotonic()
+        cursor = await self.db.executemany(*args)
+        self.record(args[0], start, max(cursor.rowcount, 0))
+        return cursor
 
     async def fetchrow(self, *args):
-        async with self.db.execute(*args) as cursor:
-            return await cursor.fetchone()
+        return await self.fetch(lambda cursor: cursor.fetchone(), *args)
 
     async def fetchall(self, *args):
-        async with self.db.execute(*args) as cursor:
-            return await cursor.fetchall()
+        return await self.fetch(lambda cursor: cursor.fetchall(), *args)
 
     async def fetchval(self, *args, **kwargs):
         col = kwargs['col'] if 'col' in kwargs else 0
-        async with self.db.execute(*args) as cursor:
-            row = await cursor.fetchone()
-            return None if row is None else row[col]
-
-    async def commit(self):
-        await self.db.commit()
+        row = await self.fetchrow(*args)
+        return None if row is None else row[col]
 
 async def fromrow(Class, db, *args):
     row = await db.fetchrow(*args)
@@ -49,39 +284,75 @@ class Cols:
     def join(self, prefix='', sep=', ', suffix=''):
         return sep.join(map(lambda x: prefix + str(x) + suffix, self.cols))
 
-class Relation(object):
-    def __init__(self, db, name, all_cols, where_cols, row):
-        object.__setattr__(self, 'db', db)
-        assert len(all_cols) == len(row)
-        object.__setattr__(self, 'cols', { col: val for col, val in zip(all_cols, row) })
-
-        async def update():
-            updated_cols = Cols(*list(set(all_cols) - set(where_cols)))
-            query = f"UPDATE { name } SET { updated_cols.join(suffix='=?') } WHERE { where_cols.join(sep=' AND ', suffix='=?') }"
-            vals = [ self.cols[x] for x in updated_cols ] + [ self.cols[x] for x in where_cols ]
-            await db.execute(query, vals)
-
-        async def delete():
-            query = f"DELETE FROM { name } WHERE { where_cols.join(sep=' AND ', suffix='=?') }"
-            vals = [ self.cols[x] for x in where_cols ]
-            await db.execute(query, vals)
-            
-        object.__setattr__(self, 'update', update)
-        object.__setattr__(self, 'delete', delete)
-
-    def check_col(self, col):
-        if col not in self.cols:
-            raise AttributeError(f'Column "{col}" not found in "{self.__class__.__name__}" relation.')
-
-    def __getattr__(self, attr):
-        self.check_col(attr)
-        return self.cols[attr]
-
-    def __setattr__(self, attr, val):
-        self.check_col(attr)
-        self.cols[attr] = val
+def tuple_getter(*attrs):
+    getter = attrgetter(*attrs)
+    return getter if len(attrs) > 1 else lambda x: (getter(x),)
+
+class RelationMeta(type):
+    '''
+    Turns the COLS of a relation into __slots__ and precompiles its statements and column getters.
+    '''
+    def __new__(mcs, name, bases, attrs):
+        if 'COLS' in attrs:
+            cols = attrs['COLS']
+            key = attrs.setdefault('KEY', Cols('id'))
+            attrs['__slots__'] = tuple(cols)
+            attrs['VALS'] = tuple(x for x in cols if x not in key)
+            attrs['DELETE_SQL'] = f"DELETE FROM { attrs['TABLE'] } WHERE { key.join(sep=' AND ', suffix='=?') }"
+            attrs['update_sqls'] = {}
+            attrs['vals'] = staticmethod(tuple_getter(*attrs['VALS']))
+            attrs['key_vals'] = staticmethod(tuple_getter(*key))
+        return super().__new__(mcs, name, bases, attrs)
+
+class Relation(metaclass=RelationMeta):
+    __slots__ = ('db', 'loaded')
+
+    def __init__(self, db, row):
+        assert len(self.COLS) == len(row)
+        self.db = db
+        for col, val in zip(self.COLS, row):
+            setattr(self, col, val)
+        self.loaded = self.vals(self)
+
+    @classmethod
+    def update_sql(cls, cols):
+        sql = cls.update_sqls.get(cols)
+        if sql is None:
+            sql = f"UPDATE { cls.TABLE } SET { Cols(*cols).join(suffix='=?') } WHERE { cls.KEY.join(sep=' AND ', suffix='=?') }"
+            cls.update_sqls[cols] = sql
+        return sql
+
+    def changed_cols(self):
+        return tuple(col for col, val in zip(self.VALS, self.loaded) if getattr(self, col) != val)
+
+    def update_params(self, cols):
+        return [getattr(self, col) for col in cols] + list(self.key_vals(self))
+
+    async def update(self):
+        cols = self.changed_cols()
+        if cols:
+            await self.db.execute(self.update_sql(cols), self.update_params(cols))
+            self.loaded = self.vals(self)
+
+    async def delete(self):
+        await self.db.execute(self.DELETE_SQL, self.key_vals(self))
+
+async def update_many(relations):
+    '''
+    Writes changed columns of all relations, one executemany per relation type and set of changed columns.
+    '''
+    groups = {}
+    for r in relations:
+        cols = r.changed_cols()
+        if cols:
+            groups.setdefault((type(r), cols), []).append(r)
+    for (Class, cols), group in groups.items():
+        await group[0].db.executemany(Class.update_sql(cols), [r.update_params(cols) for r in group])
+        for r in group:
+            r.loaded = r.vals(r)
 
 class Guild(Relation):
+    TABLE = 'guild'
     COLS = Cols('id', 'discord_id', 'current_challenge_id', 'spreadsheet_key')
 
     @staticmethod
@@ -93,9 +364,6 @@ class Guild(Relation):
             g = Guild(db, [id, discord_id, None, None])
         return g
 
-    def __init__(self, db, row):
-        super().__init__(db, 'guild', Guild.COLS, Cols('id'), row)
-
     async def fetch_current_challenge(self):
         return await Challenge.fetch_current_challenge(self.db, self.current_challenge_id)
 
@@ -115,6 +383,17 @@ class Guild(Relation):
             WHERE C.guild_id = ?''', [self.id])
         return [User(self.db, row) for row in rows]
 
+    async def fetch_users_karma(self):
+        rows = await self.db.fetchall(f'''
+            SELECT { User.COLS.join(prefix='U.') }, K.karma FROM user_karma K
+            JOIN user U ON U.id = K.user_id
+            WHERE EXISTS (
+                SELECT 1 FROM participant P
+                JOIN challenge C ON C.id = P.challenge_id
+                WHERE P.user_id = U.id AND C.guild_id = ?)
+            ORDER BY K.karma DESC''', [self.id])
+        return [(User(self.db, row[:-1]), row[-1]) for row in rows]
+
     async def fetch_challenges(self):
         rows = await self.db.fetchall(f'''
             SELECT { Challenge.COLS.join(prefix='C.') } FROM challenge C
@@ -122,7 +401,20 @@ class Guild(Relation):
             ORDER BY C.start_time''', [self.id])
         return [Challenge(self.db, row) for row in rows]
 
+    async def fetch_karma_rolls(self, from_time=None):
+        return await self.db.fetchall('''
+            SELECT R.id, R.finish_time, P1.user_id, P2.user_id, RL.score
+            FROM round R
+            JOIN challenge C ON C.id = R.challenge_id
+            JOIN roll RL ON RL.round_id = R.id
+            JOIN participant P1 ON P1.id = RL.participant_id
+            JOIN title T ON T.id = RL.title_id
+            JOIN participant P2 ON P2.id = T.participant_id
+            WHERE C.guild_id = ? AND R.is_finished AND R.finish_time >= COALESCE(?, R.finish_time)
+            ORDER BY R.finish_time, R.id''', [self.id, from_time])
+
 class User(Relation):
+    TABLE = 'user'
     COLS = Cols('id', 'discord_id', 'color', 'name')
 
     @staticmethod
@@ -132,7 +424,7 @@ class User(Relation):
             color = '#FFFFFF'
             id = (await db.execute('INSERT INTO user (discord_id, color, name) VALUES (?, ?, ?)',
                 [discord_id, color, name])).lastrowid
-            u = User(db, [id, discord_id, color, name, 0.0])
+            u = User(db, [id, discord_id, color, name])
         return u
 
     async def add_award(self, award_url, time):
@@ -141,19 +433,14 @@ class User(Relation):
     async def remove_award(self, award_url):
         await self.db.execute('DELETE FROM award WHERE url = ? AND user_id = ?', [award_url, self.id])
 
-    def __init__(self, db, row):
-        super().__init__(db, 'user', User.COLS, Cols('id'), row)
-
 class Challenge(Relation):
+    TABLE = 'challenge'
     COLS = Cols('id', 'guild_id', 'name', 'start_time', 'finish_time', 'award_url')
 
     @staticmethod
     async def fetch_current_challenge(db, guild_id):
         return await fromrow(Challenge, db, f'SELECT { Challenge.COLS } FROM challenge WHERE id = ?', [guild_id])
 
-    def __init__(self, db, row):
-        super().__init__(db, 'challenge', Challenge.COLS, Cols('id'), row)
-
     async def has_started(self):
         return await self.db.fetchval('''
             SELECT COUNT(1) FROM challenge C
@@ -167,6 +454,10 @@ class Challenge(Relation):
             ORDER BY num DESC
             LIMIT 1''', [self.id])
 
+    async def fetch_round(self, num):
+        return await fromrow(Round, self.db,
+            f'SELECT { Round.COLS } FROM round WHERE challenge_id = ? AND num = ?', [self.id, num])
+
     async def fetch_rounds(self):
         rows = await self.db.fetchall(f'''
             SELECT { Round.COLS } FROM round
@@ -174,6 +465,36 @@ class Challenge(Relation):
             ORDER BY num''', [self.id])
         return [Round(self.db, row) for row in rows]
 
+    async def fetch_snapshot(self):
+        # one read transaction, so a title added and rolled in between the queries can't be missing from titles
+        async with self.db.read_transaction():
+            users_participants = tuple(await self.fetch_users_participants())
+            pools = await self.fetch_pools()
+            title_rows = await self.db.fetchall(f'''
+                SELECT { Title.COLS.join(prefix='T.') } FROM title T
+                JOIN pool P ON P.id = T.pool_id
+                WHERE P.challenge_id = ?
+                ORDER BY T.id''', [self.id])
+            rounds = await self.fetch_rounds()
+            rows = await self.db.fetchall(f'''
+                SELECT { Roll.COLS.join(prefix='R.') } FROM roll R
+                JOIN round RN ON RN.id = R.round_id
+                WHERE RN.challenge_id = ?''', [self.id])
+        titles = tuple(Title(self.db, row) for row in title_rows)
+        pool_titles = {}
+        for t in titles:
+            pool_titles.setdefault(t.pool_id, []).append(t)
+        round_rolls = {}
+        for row in rows:
+            roll = Roll(self.db, row)
+            round_rolls.setdefault(roll.round_id, []).append(roll)
+        return ChallengeSnapshot(
+            self,
+            users_participants,
+            tuple((p, tuple(pool_titles.get(p.id, ()))) for p in pools),
+            tuple((r, tuple(round_rolls.get(r.id, ()))) for r in rounds),
+            titles)
+
     async def add_round(self, num, start, finish):
         id = (await self.db.execute('INSERT INTO round (num, challenge_id, start_time, finish_time) VALUES (?, ?, ?, ?)',
             [num, self.id, start, finish])).lastrowid
@@ -212,6 +533,13 @@ class Challenge(Relation):
             WHERE P.challenge_id = ?''', [self.id])
         return [Title(self.db, row) for row in rows]
 
+    async def fetch_title_names(self):
+        rows = await self.db.fetchall('''
+            SELECT T.name FROM title T
+            JOIN pool P ON P.id = T.pool_id
+            WHERE P.challenge_id = ?''', [self.id])
+        return { row[0] for row in rows }
+
     async def has_participant(self, user_id):
         return await self.db.fetchval(
             'SELECT COUNT(1) FROM participant WHERE challenge_id = ? AND user_id = ?', [self.id, user_id])
@@ -241,7 +569,11 @@ class Challenge(Relation):
     async def set_award(self, award_url):
         await self.db.execute('UPDATE challenge SET award_url = ? WHERE id = ?', [award_url, self.id])
 
+ChallengeSnapshot = namedtuple('ChallengeSnapshot',
+    ['challenge', 'users_participants', 'pools_titles', 'rounds_rolls', 'titles'])
+
 class Participant(Relation):
+    TABLE = 'participant'
     COLS = Cols('id', 'challenge_id', 'user_id', 'failed_round_id', 'progress_current', 'progress_total')
 
     @staticmethod
@@ -249,21 +581,16 @@ class Participant(Relation):
         await db.executemany('UPDATE participant SET failed_round_id = ? WHERE id = ?',
             map(lambda x: (round_id, x), participant_ids))
 
-    def __init__(self, db, row):
-        super().__init__(db, 'participant', Participant.COLS, Cols('id'), row)
-
     def has_failed(self):
         return self.failed_round_id is not None
 
 class Pool(Relation):
+    TABLE = 'pool'
     COLS = Cols('id', 'challenge_id', 'name')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'pool', Pool.COLS, Cols('id'), row)
-
     async def fetch_title(self, name):
         return await fromrow(Title, self.db,
-            f'SELECT { Title.COLS } FROM title WHERE challenge_id = ? AND name = ?', [self.id, name])
+            f'SELECT { Title.COLS } FROM title WHERE pool_id = ? AND name = ?', [self.id, name])
 
     async def fetch_titles(self):
         rows = await self.db.fetchall(f'SELECT { Title.COLS } FROM title WHERE pool_id = ?', [self.id])
@@ -280,18 +607,25 @@ class Pool(Relation):
             [self.id, participant_id, name, url, is_used])).lastrowid
         return Title(self.db, [id, self.id, participant_id, name, url, is_used])
 
+    async def delete(self):
+        # title.pool_id has no ON DELETE rule, so the titles have to go first
+        await self.db.execute('DELETE FROM title WHERE pool_id = ?', [self.id])
+        await super().delete()
+
+    async def add_titles(self, participant_id, names_urls):
+        await self.db.executemany(
+            'INSERT INTO title (pool_id, participant_id, name, url, is_used) VALUES (?, ?, ?, ?, 0)',
+            map(lambda x: (self.id, participant_id, x[0], x[1]), names_urls))
+
 class Title(Relation):
+    TABLE = 'title'
     COLS = Cols('id', 'pool_id', 'participant_id', 'name', 'url', 'is_used')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'title', Title.COLS, Cols('id'), row)
 
 class Round(Relation):
+    TABLE = 'round'
     COLS = Cols('id', 'num', 'challenge_id', 'start_time', 'finish_time', 'is_finished')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'round', Round.COLS, Cols('id'), row)
-
     async def fetch_rolls_watchers_proposers(self):
         rows = await self.db.fetchall(f'''
             SELECT
@@ -323,12 +657,15 @@ class Round(Relation):
         await self.db.execute(
             'INSERT INTO roll (round_id, participant_id, title_id) VALUES (?, ?, ?)', [self.id, participant_id, title_id])
 
+    async def add_rolls(self, participant_title_ids):
+        await self.db.executemany('INSERT INTO roll (round_id, participant_id, title_id) VALUES (?, ?, ?)',
+            map(lambda x: (self.id, x[0], x[1]), participant_title_ids))
+
 class Roll(Relation):
+    TABLE = 'roll'
+    KEY = Cols('round_id', 'participant_id')
     COLS = Cols('round_id', 'participant_id', 'title_id', 'score')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'roll', Roll.COLS, Cols('round_id', 'participant_id'), row)
-
     async def fetch_title(self):
         return await fromrow(Title, self.db, f'SELECT { Title.COLS } FROM title WHERE id = ?', [self.title_id])
 
@@ -352,49 +689,67 @@ class Roll(Relation):
         return User(self.db, row)
 
 class KarmaHistory(Relation):
+    TABLE = 'karma_history'
+    KEY = Cols('user_id', 'time')
     COLS = Cols('user_id', 'karma', 'time')
 
-    def __init__(self, db, row):
-        super().__init__(db, 'karma_history', KarmaHistory.COLS, Cols('user_id', 'time'), row)
-
     @staticmethod
     async def fetch_user_karma(db, user_id):
+        # user_karma is kept in sync with karma_history by triggers, see migrations/0001_user_karma.sql
+        return await db.fetchval('SELECT karma FROM user_karma WHERE user_id = ?', [user_id])
+
+    @staticmethod
+    async def clear_guild_karma_history(db, guild_id, from_time=None):
+        await db.execute('''
+            DELETE FROM karma_history
+            WHERE time >= COALESCE(?, time) AND user_id IN (
+                SELECT P.user_id FROM participant P
+                JOIN challenge C ON C.id = P.challenge_id
+                WHERE C.guild_id = ?)''', [from_time, guild_id])
+
+    @staticmethod
+    async def fetch_users_karma(db, user_ids, before_time):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        # SQLite returns the bare "karma" column from the row holding MAX(time)
         rows = await db.fetchall(f'''
-            SELECT karma
+            SELECT user_id, karma, MAX(time)
             FROM karma_history
-            WHERE user_id = ?
-            ORDER BY time DESC
-            LIMIT 1''', [user_id])
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) }) AND time < ?
+            GROUP BY user_id''', user_ids + [before_time])
+        return { row[0]: row[1] for row in rows }
 
-        print(rows)
-        if rows:
-            return rows[-1][0]
-        else:
-            return None # todo: maybe use constant -> starting_karma
+    @staticmethod
+    async def set_users_karma(db, karma, time):
+        rows = [(user_id, k, time) for user_id, k in karma.items()]
+        await db.executemany('DELETE FROM karma_history WHERE user_id = ? AND time = ?',
+            map(lambda x: (x[0], x[2]), rows))
+        await KarmaHistory.insert_karma_many(db, rows)
 
     @staticmethod
-    async def clear_user_karma_history(db, user_id):
-        await db.execute(f'''
-            DELETE FROM karma_history
-            WHERE user_id = ?''', [user_id])
+    async def insert_karma_many(db, rows):
+        await db.executemany('INSERT INTO karma_history (user_id, karma, time) VALUES (?, ?, ?)', rows)
 
     @staticmethod
-    async def insert_or_update_karma(db, user_id, karma, time):
-        row = await db.fetchrow(f'''
+    async def fetch_karma_version(db, user_ids):
+        # changes whenever any of the users' history rows are added, removed or recalculated
+        return await db.fetchrow(f'''
+            SELECT MAX(time), COUNT(*), TOTAL(karma)
+            FROM karma_history
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) })''', list(user_ids))
+
+    @staticmethod
+    async def fetch_karma_histories(db, user_ids):
+        rows = await db.fetchall(f'''
             SELECT { KarmaHistory.COLS }
             FROM karma_history
-            WHERE user_id = ? AND time = ?
-            ORDER BY time''', [user_id, time])
-
-        if row is None:
-            await db.execute('''
-                INSERT INTO karma_history
-                (user_id, karma, time)
-                VALUES(?, ?, ?)''', [user_id, karma, time])
-        else:
-            karma_history = KarmaHistory(db, row)
-            karma_history.karma = karma
-            await karma_history.update()
+            WHERE user_id IN ({ ', '.join('?' * len(user_ids)) })
+            ORDER BY user_id, time''', list(user_ids))
+        histories = { id: [] for id in user_ids }
+        for row in rows:
+            histories[row[0]].append(KarmaHistory(db, row))
+        return histories
 
     @staticmethod
     async def fetch_karma_history(db, user_id):
@@ -406,74 +761,214 @@ class KarmaHistory(Relation):
 
         return [KarmaHistory(db, row) for row in rows]
 
-class UserStats:
-    @staticmethod
-    async def fetch(db, user_id, guild_id):
-        row = await db.fetchrow('''
-            SELECT COUNT(*), COALESCE(SUM(CASE WHEN P.failed_round_id IS NULL AND C.finish_time is NOT NULL THEN 1 ELSE 0 END),0) FROM challenge C
-            JOIN participant P ON P.challenge_id = C.id
-            WHERE P.user_id = ?''', [user_id])
-        num_challenges,num_completed = row
+class TitleInfo(Relation):
+    TABLE = 'title_info'
+    KEY = Cols('provider', 'external_id')
+    COLS = Cols('provider', 'external_id', 'name', 'score', 'length', 'complexity', 'error', 'fetch_time')
 
-        avg_rate = await db.fetchval('''
-            SELECT AVG(R.score) FROM roll R
-            JOIN participant P ON P.id = R.participant_id
-            WHERE P.user_id = ? AND R.score IS NOT NULL''', [user_id])
+    @staticmethod
+    async def fetch(db, provider, external_id):
+        return await fromrow(TitleInfo, db,
+            f'SELECT { TitleInfo.COLS } FROM title_info WHERE provider = ? AND external_id = ?', [provider, external_id])
 
-        avg_title_score = await db.fetchval('''
-            SELECT AVG(R.score) FROM roll R
-            JOIN title T ON T.id = R.title_id
-            JOIN participant P ON P.id = T.participant_id
-            WHERE P.user_id = ? AND R.score IS NOT NULL''', [user_id])
+    @staticmethod
+    async def store(db, row):
+        await db.execute(f'''
+            INSERT OR REPLACE INTO title_info ({ TitleInfo.COLS })
+            VALUES ({ ', '.join('?' * len(TitleInfo.COLS)) })''', row)
+        return TitleInfo(db, row)
 
-        most_watched = await db.fetchall('''
-            SELECT U.name, COUNT(U.id) AS count FROM roll R
-            JOIN participant P1 ON P1.id = R.participant_id
+    @staticmethod
+    async def store_many(db, rows):
+        await db.executemany(f'''
+            INSERT OR REPLACE INTO title_info ({ TitleInfo.COLS })
+            VALUES ({ ', '.join('?' * len(TitleInfo.COLS)) })''', rows)
+
+class GuildStats:
+    LEADERBOARDS = {
+        'karma': '''
+            SELECT U.name, K.karma FROM guild_user_stats S
+            JOIN user U ON U.id = S.user_id
+            JOIN user_karma K ON K.user_id = S.user_id
+            WHERE S.guild_id = ?
+            ORDER BY K.karma DESC
+            LIMIT ?''',
+        'given': '''
+            SELECT U.name, S.given_sum / S.given_count avg FROM guild_user_stats S
+            JOIN user U ON U.id = S.user_id
+            WHERE S.guild_id = ? AND S.given_count > 0
+            ORDER BY avg DESC
+            LIMIT ?''',
+        'titles': '''
+            SELECT U.name, S.received_sum / S.received_count avg FROM guild_user_stats S
+            JOIN user U ON U.id = S.user_id
+            WHERE S.guild_id = ? AND S.received_count > 0
+            ORDER BY avg DESC
+            LIMIT ?''',
+        'completion': '''
+            SELECT U.name, 100.0 * S.num_completed / S.num_challenges rate FROM guild_user_stats S
+            JOIN user U ON U.id = S.user_id
+            WHERE S.guild_id = ? AND S.num_challenges > 0
+            ORDER BY rate DESC, S.num_completed DESC
+            LIMIT ?''',
+        'pairs': '''
+            SELECT W.name, P.name, S.count FROM guild_pair_stats S
+            JOIN user W ON W.id = S.watcher_id
+            JOIN user P ON P.id = S.proposer_id
+            WHERE S.guild_id = ? AND S.watcher_id != S.proposer_id
+            ORDER BY S.count DESC
+            LIMIT ?''',
+    }
 
-            JOIN title T ON T.id = R.title_id
-            JOIN participant P2 ON P2.id = T.participant_id
-            JOIN user U ON U.id = P2.user_id
+    @staticmethod
+    async def fetch_pending(db, guild_id):
+        '''
+        Finished rounds and challenges of the guild that aren't accounted for in the summary tables yet.
+        '''
+        round_ids = [x[0] for x in await db.fetchall('''
+            SELECT R.id FROM round R
+            JOIN challenge C ON C.id = R.challenge_id
+            WHERE C.guild_id = ? AND R.is_finished
+                AND NOT EXISTS (SELECT 1 FROM guild_stats_round S WHERE S.round_id = R.id)''', [guild_id])]
+        challenge_ids = [x[0] for x in await db.fetchall('''
+            SELECT C.id FROM challenge C
+            WHERE C.guild_id = ? AND C.finish_time IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM guild_stats_challenge S WHERE S.challenge_id = C.id)''', [guild_id])]
+        return round_ids, challenge_ids
 
-            WHERE P1.user_id = ?
-            GROUP BY U.id
-            ORDER BY count DESC LIMIT 6''', [user_id])
+    @staticmethod
+    async def update(db, guild_id):
+        '''
+        Folds finished rounds and challenges that aren't accounted for yet into the guild's summary tables.
+        '''
+        round_ids, challenge_ids = await GuildStats.fetch_pending(db, guild_id)
+        if round_ids:
+            rounds = ', '.join('?' * len(round_ids))
+            await db.execute(f'''
+                INSERT INTO guild_user_stats (guild_id, user_id, given_sum, given_count)
+                SELECT ?, P.user_id, SUM(R.score), COUNT(R.score) FROM roll R
+                JOIN participant P ON P.id = R.participant_id
+                WHERE R.round_id IN ({ rounds }) AND R.score IS NOT NULL
+                GROUP BY P.user_id
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                    given_sum = given_sum + excluded.given_sum,
+                    given_count = given_count + excluded.given_count''', [guild_id] + round_ids)
+            await db.execute(f'''
+                INSERT INTO guild_user_stats (guild_id, user_id, received_sum, received_count)
+                SELECT ?, P.user_id, SUM(R.score), COUNT(R.score) FROM roll R
+                JOIN title T ON T.id = R.title_id
+                JOIN participant P ON P.id = T.participant_id
+                WHERE R.round_id IN ({ rounds }) AND R.score IS NOT NULL
+                GROUP BY P.user_id
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                    received_sum = received_sum + excluded.received_sum,
+                    received_count = received_count + excluded.received_count''', [guild_id] + round_ids)
+            await db.execute(f'''
+                INSERT INTO guild_pair_stats (guild_id, watcher_id, proposer_id, count)
+                SELECT ?, P1.user_id, P2.user_id, COUNT(*) FROM roll R
+                JOIN participant P1 ON P1.id = R.participant_id
+                JOIN title T ON T.id = R.title_id
+                JOIN participant P2 ON P2.id = T.participant_id
+                WHERE R.round_id IN ({ rounds })
+                GROUP BY P1.user_id, P2.user_id
+                ON CONFLICT (guild_id, watcher_id, proposer_id) DO UPDATE SET
+                    count = count + excluded.count''', [guild_id] + round_ids)
+            await db.executemany('INSERT INTO guild_stats_round (round_id) VALUES (?)', [(x,) for x in round_ids])
+
+        if challenge_ids:
+            await db.execute(f'''
+                INSERT INTO guild_user_stats (guild_id, user_id, num_challenges, num_completed)
+                SELECT ?, P.user_id, COUNT(*), SUM(P.failed_round_id IS NULL) FROM participant P
+                WHERE P.challenge_id IN ({ ', '.join('?' * len(challenge_ids)) })
+                GROUP BY P.user_id
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                    num_challenges = num_challenges + excluded.num_challenges,
+                    num_completed = num_completed + excluded.num_completed''', [guild_id] + challenge_ids)
+            await db.executemany('INSERT INTO guild_stats_challenge (challenge_id) VALUES (?)', [(x,) for x in challenge_ids])
+
+        return len(round_ids), len(challenge_ids)
 
-        most_sniped = await db.fetchall('''
-            SELECT U.name, COUNT(U.id) AS count FROM roll R
-            JOIN participant P1 ON P1.id = R.participant_id
-            JOIN user U ON U.id = P1.user_id
+    @staticmethod
+    async def fetch_leaderboard(db, guild_id, kind, limit=10):
+        return await db.fetchall(GuildStats.LEADERBOARDS[kind], [guild_id, limit])
 
-            JOIN title T ON T.id = R.title_id
-            JOIN participant P2 ON P2.id = T.participant_id
+class UserStats:
+    NUM_PARTNERS = 6
 
-            WHERE P2.user_id = ?
-            GROUP BY U.id
-            ORDER BY count DESC LIMIT 6''', [user_id])
+    @staticmethod
+    async def fetch(db, user_id, guild_id):
+        params = { 'user_id': user_id, 'guild_id': guild_id, 'num_partners': UserStats.NUM_PARTNERS }
+        row = await db.fetchrow('''
+            WITH
+            challenges AS (
+                SELECT COUNT(*) num, COALESCE(SUM(CASE WHEN P.failed_round_id IS NULL AND C.finish_time is NOT NULL THEN 1 ELSE 0 END),0) completed
+                FROM challenge C
+                JOIN participant P ON P.challenge_id = C.id
+                WHERE P.user_id = :user_id),
+            given AS (
+                SELECT AVG(R.score) avg FROM roll R
+                JOIN participant P ON P.id = R.participant_id
+                WHERE P.user_id = :user_id AND R.score IS NOT NULL),
+            received AS (
+                SELECT AVG(R.score) avg FROM roll R
+                JOIN title T ON T.id = R.title_id
+                JOIN participant P ON P.id = T.participant_id
+                WHERE P.user_id = :user_id AND R.score IS NOT NULL),
+            last_round AS (
+                SELECT R.finish_time, R.is_finished FROM guild G
+                JOIN round R ON R.challenge_id = G.current_challenge_id
+                JOIN participant P ON P.challenge_id = G.current_challenge_id AND P.user_id = :user_id
+                WHERE G.id = :guild_id AND P.failed_round_id IS NULL
+                ORDER BY R.num DESC
+                LIMIT 1)
+            SELECT
+                challenges.num,
+                challenges.completed,
+                given.avg,
+                received.avg,
+                (SELECT finish_time FROM last_round WHERE NOT is_finished),
+                (SELECT karma FROM user_karma WHERE user_id = :user_id)
+            FROM challenges, given, received''', params)
+        num_challenges, num_completed, avg_rate, avg_title_score, finish_time, karma = row
+
+        # 0 - titles the user watched grouped by proposer, 1 - the user's titles grouped by watcher
+        partners = await db.fetchall('''
+            SELECT kind, name, count FROM (
+                SELECT 0 kind, U.name name, COUNT(*) count, ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) num
+                FROM roll R
+                JOIN participant P1 ON P1.id = R.participant_id
+                JOIN title T ON T.id = R.title_id
+                JOIN participant P2 ON P2.id = T.participant_id
+                JOIN user U ON U.id = P2.user_id
+                WHERE P1.user_id = :user_id
+                GROUP BY U.id
+                UNION ALL
+                SELECT 1 kind, U.name name, COUNT(*) count, ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) num
+                FROM title T
+                JOIN participant P2 ON P2.id = T.participant_id
+                JOIN roll R ON R.title_id = T.id
+                JOIN participant P1 ON P1.id = R.participant_id
+                JOIN user U ON U.id = P1.user_id
+                WHERE P2.user_id = :user_id
+                GROUP BY U.id)
+            WHERE num <= :num_partners
+            ORDER BY kind, num''', params)
+        most_watched = [(x[1], x[2]) for x in partners if x[0] == 0]
+        most_sniped = [(x[1], x[2]) for x in partners if x[0] == 1]
 
         awards = await db.fetchall('''
             SELECT * FROM (
                 SELECT C.award_url url, C.finish_time time FROM challenge C
                 JOIN participant P ON P.challenge_id = C.id
-                WHERE P.user_id = ? AND C.guild_id = ?
+                WHERE P.user_id = :user_id AND C.guild_id = :guild_id
                     AND P.failed_round_id IS NULL AND C.award_url IS NOT NULL
                 UNION
                 SELECT A.url url, A.time time from award A
-                JOIN user U ON A.user_id = U.id
-                WHERE A.user_id = ?
+                WHERE A.user_id = :user_id
             )
-            ORDER BY time''', [user_id, guild_id, user_id])
+            ORDER BY time''', params)
         awards = [x[0] for x in awards]
 
-        karma = await KarmaHistory.fetch_user_karma(db, user_id)
-
-        finish_time = None
-        challenge = await Challenge.fetch_current_challenge(db, guild_id)
-        if challenge is not None:
-            last_round = await challenge.fetch_last_round()
-            participant = await challenge.fetch_participant(user_id)
-            if last_round is not None and participant is not None and not participant.has_failed and not last_round.is_finished:
-                finish_time = last_round.finish_time
-
         return UserStats(num_challenges,
                          num_completed,
                          avg_rate,
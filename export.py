@@ -1,14 +1,27 @@
 import pygsheets
 import asyncio
+import json
+import os
+import random
 import re
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
 from pygsheets.exceptions import WorksheetNotFound
 from pygsheets.custom_types import HorizontalAlignment
 from pygsheets import Cell, DataRange
 from pygsheets.utils import format_addr
 from db import Challenge
+from metrics import metrics
 
-gsheets_client = pygsheets.authorize()
+# Last grid written to every challenge's worksheet, used to send only changed cells
+GRID_DIR = 'sheets_cache'
+
+# Rate limited or transiently failed requests are retried with exponential backoff
+RETRY_STATUSES = (429, 500, 503)
+MAX_RETRIES = 5
 
 def col2tuple(col):
     try:
@@ -34,62 +47,80 @@ def score_col(score):
     else:
         return '#6AA84F'
 
+# A cell is described by a hashable spec so grids can be diffed against the last exported one:
+# (value, color, bold, underline, strikethrough, centered)
+def make_cell(addr, spec):
+    value, color, bold, underline, strikethrough, centered = spec
+    cell = Cell(addr, value)
+    cell.color = col2tuple(color)
+    if bold:
+        cell.set_text_format('bold', True)
+    if underline is not None:
+        cell.set_text_format('underline', underline)
+    if strikethrough:
+        cell.set_text_format('strikethrough', True)
+    if centered:
+        cell.horizontal_alignment = HorizontalAlignment.CENTER
+    update_fgcolor(cell)
+    return cell
+
 class ColWriter:
     def __init__(self, users_participants):
         self.col = 0
         self.row = 0
         self.users = { p.id: u for u, p in users_participants }
-        self.cells = []
-
-    def new_cell(self, value):
-        return Cell((self.row + 1, self.col + 1), value)
+        self.cells = {}
+        self.shape = []
 
-    def add_cell(self, cell):
-        update_fgcolor(cell)
-        self.cells.append(cell)
+    def add_cell(self, value, color, bold=False, underline=None, strikethrough=False, centered=False):
+        self.cells[(self.row + 1, self.col + 1)] = (value, color, bold, underline, strikethrough, centered)
         self.row += 1
 
     def write_header(self, text):
-        cell = self.new_cell(text)
-        cell.set_text_format('bold', True)
-        cell.color = col2tuple('#C0C0C0')
-        cell.horizontal_alignment = HorizontalAlignment.CENTER
-        self.add_cell(cell)
+        self.add_cell(text, '#C0C0C0', bold=True, centered=True)
 
     def write_participant(self, participant):
         user = self.users[participant.id]
-        cell = self.new_cell(user.name)
-        cell.color = col2tuple(user.color)
-        self.add_cell(cell)
+        self.add_cell(user.name, user.color)
 
     def write_score(self, score):
-        cell = self.new_cell('-' if score is None else score)
-        cell.color = col2tuple(score_col(score))
-        cell.horizontal_alignment = HorizontalAlignment.CENTER
-        self.add_cell(cell)
+        self.add_cell('-' if score is None else score, score_col(score), centered=True)
 
     def write_title(self, title, failed=False):
-        cell = self.new_cell(title.name)
+        value = title.name
+        underline = None
         if title.url is not None:
-            cell.value = f'=HYPERLINK("{ title.url }"; "{ title.name }")'
-            cell.set_text_format('underline', False)
-        user = self.users[title.participant_id]
-        cell.color = col2tuple(user.color)
+            value = f'=HYPERLINK("{ title.url }"; "{ title.name }")'
+            underline = False
+        color = self.users[title.participant_id].color
         if failed:
-            cell.set_text_format('strikethrough', True)
-            cell.color = col2tuple('#FF0000')
-        self.add_cell(cell)
+            color = '#FF0000'
+        self.add_cell(value, color, underline=underline, strikethrough=failed)
 
     def write_fail(self):
-        cell = self.new_cell('FAILED')
-        cell.color = col2tuple('#FF0000')
-        cell.horizontal_alignment = HorizontalAlignment.CENTER
-        self.add_cell(cell)
+        self.add_cell('FAILED', '#FF0000', centered=True)
 
     def next_col(self):
+        self.shape.append(self.row)
         self.col += 1
         self.row = 0
 
+def load_grid(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return data['worksheet'], data['shape'], { (x[0], x[1]): tuple(x[2:]) for x in data['cells'] }
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_grid(path, worksheet_name, shape, cells):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({ 'worksheet': worksheet_name, 'shape': shape,
+            'cells': [list(addr) + list(spec) for addr, spec in cells.items()] }, f)
+    os.replace(tmp_path, path)
+
 def update_stats(stats, participant, score, num_rounds):
     id = participant.id
     if id not in stats:
@@ -103,7 +134,9 @@ def update_stats(stats, participant, score, num_rounds):
     n = 1 if n is None else n + 1
     stats[id] = (min_, max_, sum_, n)
 
-def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_titles):
+def build_grid(snapshot):
+    users_participants = snapshot.users_participants
+    rounds_rolls = snapshot.rounds_rolls
     writer = ColWriter(users_participants)
     writer.write_header('Participants')
     sorted_participants = list(map(lambda x: x[1], sorted(users_participants, key=lambda x: x[0].name)))
@@ -112,7 +145,7 @@ def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_t
         writer.write_participant(participant)
     writer.next_col()
 
-    titles = { t.id: t for t in all_titles }
+    titles = { t.id: t for t in snapshot.titles }
     stats = {}
     for round, rolls in rounds_rolls:
         roll_by_participant_id = { r.participant_id: r for r in rolls }
@@ -141,32 +174,95 @@ def sync_export(worksheet, users_participants, rounds_rolls, pools_titles, all_t
             writer.write_score(stat)
         writer.next_col()
 
-    for pool, titles in pools_titles:
+    for pool, titles in snapshot.pools_titles:
         writer.write_header(f'{ pool.name } (unused titles)')
         for title in titles:
             if not title.is_used:
                 writer.write_title(title)
         writer.next_col()
+    return writer
 
-    # Cell((0, 0)) clears the entire screen
-    worksheet.update_cells([Cell((0, 0))] + writer.cells)
-    worksheet.adjust_column_width(1, worksheet.cols)
+def with_backoff(f, *args):
+    '''
+    Retries a single Sheets API call, so a rate limited request never repeats the calls that already went through.
+    '''
+    for attempt in range(MAX_RETRIES):
+        try:
+            return f(*args)
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt + random.random())
 
-async def export(spreadsheet_key, challenge):
-    spreadsheet = gsheets_client.open_by_key(spreadsheet_key)
+def open_worksheet(spreadsheet, name):
     try:
-        worksheet = spreadsheet.worksheet_by_title(challenge.name)
+        return with_backoff(spreadsheet.worksheet_by_title, name)
     except WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(challenge.name)
-
-    users_participants = await challenge.fetch_users_participants()
-    pools = await challenge.fetch_pools()
-    pool_titles = [ await pool.fetch_titles() for pool in pools ]
-    pools_titles = list(zip(pools, pool_titles))
-    all_titles = [ t for pt in pool_titles for t in pt ]
-    rounds = await challenge.fetch_rounds()
-    rounds_rolls = list(zip(rounds, [ await round.fetch_rolls() for round in rounds ]))
-
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None,
-        sync_export, worksheet, users_participants, rounds_rolls, pools_titles, all_titles)
\ No newline at end of file
+        return with_backoff(spreadsheet.add_worksheet, name)
+
+class SheetsExporter:
+    '''
+    Exports challenges on a long-lived thread pool. The OAuth token is read, or asked for on the first run, once when
+    the bot starts. pygsheets talks through httplib2, which is not thread-safe, so every worker thread builds its own
+    client from those credentials and keeps it, along with its spreadsheet handles, between exports.
+    '''
+    def __init__(self, workers=1):
+        self.credentials = pygsheets.authorize().oauth
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+
+    def open_spreadsheet(self, spreadsheet_key):
+        if not hasattr(self.local, 'client'):
+            self.local.client = pygsheets.authorize(custom_credentials=self.credentials)
+            self.local.spreadsheets = {}
+        # a Spreadsheet caches its sheet list, which add_worksheet updates, so handles are not shared between threads
+        if spreadsheet_key not in self.local.spreadsheets:
+            self.local.spreadsheets[spreadsheet_key] = with_backoff(self.local.client.open_by_key, spreadsheet_key)
+        return self.local.spreadsheets[spreadsheet_key]
+
+    def export_snapshot(self, spreadsheet_key, snapshot, full=False):
+        '''
+        Writes the challenge to its worksheet, returns False without any Sheets request if it was already up to date.
+        '''
+        writer = build_grid(snapshot)
+        name = snapshot.challenge.name
+        grid_path = os.path.join(GRID_DIR, f'{ spreadsheet_key }_{ snapshot.challenge.id }.json')
+        last_grid = None if full else load_grid(grid_path)
+        changed = None
+        if last_grid is not None and last_grid[0] == name and last_grid[1] == writer.shape:
+            old_cells = last_grid[2]
+            changed = [make_cell(addr, spec) for addr, spec in writer.cells.items() if old_cells.get(addr) != spec]
+            if not changed:
+                return False
+
+        try:
+            worksheet = open_worksheet(self.open_spreadsheet(spreadsheet_key), name)
+            if changed is None:
+                # Cell((0, 0)) clears the entire screen
+                cells = [Cell((0, 0))] + [make_cell(addr, spec) for addr, spec in writer.cells.items()]
+                with_backoff(worksheet.update_cells, cells)
+                with_backoff(worksheet.adjust_column_width, 1, worksheet.cols)
+            else:
+                with_backoff(worksheet.update_cells, changed)
+        except HttpError:
+            # the cached sheet list may be what is out of date, the next export opens the spreadsheet again
+            self.local.spreadsheets.pop(spreadsheet_key, None)
+            raise
+        save_grid(grid_path, name, writer.shape, writer.cells)
+        return True
+
+    async def export(self, spreadsheet_key, challenge, full=False):
+        snapshot = await challenge.fetch_snapshot()
+        loop = asyncio.get_event_loop()
+        with metrics.timer('external_seconds', service='sheets'):
+            await loop.run_in_executor(self.executor, self.export_snapshot, spreadsheet_key, snapshot, full)
+
+    async def export_all(self, spreadsheet_key, challenges):
+        '''
+        Exports challenges concurrently, returns the number of worksheets that actually changed.
+        '''
+        snapshots = [await c.fetch_snapshot() for c in challenges]
+        loop = asyncio.get_event_loop()
+        with metrics.timer('external_seconds', service='sheets'):
+            return sum(await asyncio.gather(*(loop.run_in_executor(self.executor, self.export_snapshot,
+                spreadsheet_key, snapshot) for snapshot in snapshots)))
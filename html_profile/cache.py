@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+from collections import OrderedDict
+
+class ImageCache:
+    '''
+    Content-addressed cache of rendered images: an in-memory LRU in front of a directory, both bounded in bytes.
+    '''
+    def __init__(self, directory, memory_limit, disk_limit):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        os.makedirs(directory, exist_ok=True)
+        files = [os.path.join(directory, f) for f in os.listdir(directory) if not f.endswith('.tmp')]
+        self.disk = OrderedDict((f, os.path.getsize(f)) for f in sorted(files, key=os.path.getmtime))
+        self.disk_size = sum(self.disk.values())
+
+    @staticmethod
+    def key(html_string, css_path):
+        h = hashlib.sha256(html_string.encode('utf-8'))
+        with open(css_path, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = os.path.join(self.directory, key)
+        if path not in self.disk:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.disk_size -= self.disk.pop(path)
+            return None
+        os.utime(path)
+        self.disk.move_to_end(path)
+        self.put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        self.put_memory(key, data)
+        path = os.path.join(self.directory, key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.disk_size += len(data) - self.disk.pop(path, 0)
+        self.disk[path] = len(data)
+        while self.disk_size > self.disk_limit and len(self.disk) > 1:
+            old_path, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def put_memory(self, key, data):
+        self.memory_size += len(data) - len(self.memory.pop(key, b''))
+        self.memory[key] = data
+        while self.memory_size > self.memory_limit and len(self.memory) > 1:
+            self.memory_size -= len(self.memory.popitem(last=False)[1])
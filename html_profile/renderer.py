@@ -1,20 +1,55 @@
 import imgkit
-import hashlib
-import random
+import asyncio
+import time
 
-from utils import gen_fname
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
 
-def render_html_from_string(html_string, css_path):
-    options = {
-        "enable-local-file-access": None,
-        "height": 1000,
-        "width": 1800,
-        "disable-smart-width": None,
-        "quality": 100,
-        "zoom": 4,
-        "quiet": None,
-    }
+OPTIONS = {
+    "enable-local-file-access": None,
+    "height": 1000,
+    "width": 1800,
+    "disable-smart-width": None,
+    "quality": 100,
+    "zoom": 4,
+    "quiet": None,
+}
 
-    fname = gen_fname('.jpg')
-    imgkit.from_string(html_string, fname, options=options, css=css_path)
-    return fname
+class RenderTimeout(Exception):
+    pass
+
+def render_html_from_string(html_string, css_path, image_format='jpg'):
+    # output_path=False makes imgkit return the image from wkhtmltoimage's stdout
+    return imgkit.from_string(html_string, False, options=dict(OPTIONS, format=image_format), css=css_path)
+
+class Renderer:
+    '''
+    Renders html to image bytes on a fixed pool of worker threads, at most one wkhtmltoimage process per worker.
+    '''
+    def __init__(self, workers=2, queue_timeout=30, num_samples=1000):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='renderer')
+        self.slots = asyncio.Semaphore(workers)
+        self.queue_timeout = queue_timeout
+        self.latencies = deque(maxlen=num_samples)
+
+    async def render(self, html_string, css_path, image_format='jpg'):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise RenderTimeout(f'No render worker freed up in {self.queue_timeout}s.')
+        try:
+            start = time.monotonic()
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(self.executor, render_html_from_string, html_string, css_path, image_format)
+            self.latencies.append(time.monotonic() - start)
+            metrics.observe('external_seconds', self.latencies[-1], service='imgkit')
+            return data
+        finally:
+            self.slots.release()
+
+    def percentiles(self, ps=(50, 90, 99)):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return { p: latencies[min(len(latencies) - 1, len(latencies) * p // 100)] for p in ps }
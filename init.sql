@@ -87,10 +87,10 @@ CREATE TABLE roll (
 );
 
 CREATE TABLE award (
-	participant_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
 	"url" TEXT DEFAULT NULL,
 	"time" TIMESTAMP NOT NULL,
-	FOREIGN KEY (participant_id) REFERENCES participant (id)
+	FOREIGN KEY (user_id) REFERENCES user (id)
 );
 
 CREATE TABLE karma_history (
@@ -0,0 +1,23 @@
+STARTING_KARMA = 0
+
+def proposer_delta(score):
+    return score
+
+def watcher_delta(score):
+    return score if score < 5 else 5 + (score - 5) * 0.25
+
+def apply_roll(karma, watcher_id, proposer_id, score):
+    '''
+    Applies a single rated roll to the running karma map. Returns ids of the users whose karma changed.
+    '''
+    if score is None or watcher_id == proposer_id:
+        return ()
+    karma[proposer_id] = karma.get(proposer_id, STARTING_KARMA) + proposer_delta(score)
+    karma[watcher_id] = karma.get(watcher_id, STARTING_KARMA) + watcher_delta(score)
+    return (proposer_id, watcher_id)
+
+def apply_round(karma, rolls_watchers_proposers):
+    changed = set()
+    for roll, watcher, proposer in rolls_watchers_proposers:
+        changed.update(apply_roll(karma, watcher.id, proposer.id, roll.score))
+    return changed
@@ -0,0 +1,44 @@
+import asyncio
+import io
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+DPI = 150
+
+def render_karma_graph(series):
+    '''
+    Renders [(name, times, karmas)] to png bytes. Uses a standalone Figure so nothing is left behind in pyplot.
+    '''
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    for name, times, karmas in series:
+        ax.plot(times, karmas, label=name, marker='.')
+    ax.tick_params(axis='x', labelrotation=30)
+    ax.legend()
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI)
+    return buf.getvalue()
+
+class KarmaGraphRenderer:
+    def __init__(self, workers=1, cache_size=64):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def get(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        return self.cache.get(key)
+
+    async def render(self, key, series):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(self.executor, render_karma_graph, series)
+        self.cache[key] = data
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+
+PREFIX = 'gauntlet_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-th observation.
+        '''
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    '''
+    In-process histograms and counters keyed by name and labels, rendered in Prometheus text format.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def histograms_named(self, name):
+        return [(dict(labels), h) for (n, labels), h in self.histograms.items() if n == name]
+
+    def prometheus(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda x: x[0]):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {h.sum}')
+            lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    async def write_periodically(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.write(path)
+
+    async def serve(self, host, port):
+        '''
+        Serves /metrics over http, returns the runner to clean up on shutdown.
+        '''
+        async def handle(request):
+            return web.Response(text=self.prometheus(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+metrics = Metrics()
@@ -0,0 +1,33 @@
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+def list_migrations():
+    migrations = []
+    for fname in os.listdir(MIGRATIONS_DIR):
+        m = re.match(r'^(\d+)_.*\.sql$', fname)
+        if m:
+            migrations.append((int(m.group(1)), os.path.join(MIGRATIONS_DIR, fname)))
+    return sorted(migrations)
+
+async def fetch_version(connection):
+    async with connection.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+async def migrate(connection):
+    '''
+    Applies every migration newer than the database's user_version, each in its own transaction.
+    '''
+    version = await fetch_version(connection)
+    for num, path in list_migrations():
+        if num <= version:
+            continue
+        with open(path, 'r') as f:
+            script = f.read()
+        try:
+            await connection.executescript(f'BEGIN;\n{ script }\nPRAGMA user_version = { num };\nCOMMIT;')
+        except Exception:
+            await connection.rollback()
+            raise
+        print(f'Applied migration { os.path.basename(path) }')
@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS user_karma (
+	user_id INTEGER NOT NULL PRIMARY KEY,
+	karma REAL NOT NULL,
+	"time" TIMESTAMP NOT NULL,
+
+	FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE INDEX IF NOT EXISTS karma_history_user_id_time ON karma_history (user_id, "time");
+CREATE INDEX IF NOT EXISTS user_karma_karma ON user_karma (karma DESC);
+
+CREATE TRIGGER IF NOT EXISTS karma_history_after_insert AFTER INSERT ON karma_history
+BEGIN
+	INSERT INTO user_karma (user_id, karma, "time") VALUES (NEW.user_id, NEW.karma, NEW."time")
+	ON CONFLICT (user_id) DO UPDATE SET karma = excluded.karma, "time" = excluded."time"
+	WHERE excluded."time" >= user_karma."time";
+END;
+
+CREATE TRIGGER IF NOT EXISTS karma_history_after_delete AFTER DELETE ON karma_history
+WHEN OLD."time" >= (SELECT "time" FROM user_karma WHERE user_id = OLD.user_id)
+BEGIN
+	DELETE FROM user_karma WHERE user_id = OLD.user_id;
+	INSERT INTO user_karma (user_id, karma, "time")
+	SELECT user_id, karma, MAX("time") FROM karma_history WHERE user_id = OLD.user_id GROUP BY user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS karma_history_after_update AFTER UPDATE ON karma_history
+BEGIN
+	DELETE FROM user_karma WHERE user_id IN (OLD.user_id, NEW.user_id);
+	INSERT INTO user_karma (user_id, karma, "time")
+	SELECT user_id, karma, MAX("time") FROM karma_history WHERE user_id IN (OLD.user_id, NEW.user_id) GROUP BY user_id;
+END;
+
+INSERT OR IGNORE INTO user_karma (user_id, karma, "time")
+SELECT user_id, karma, MAX("time") FROM karma_history GROUP BY user_id;
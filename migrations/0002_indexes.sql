@@ -0,0 +1,7 @@
+CREATE INDEX IF NOT EXISTS challenge_guild_id_start_time ON challenge (guild_id, start_time);
+CREATE INDEX IF NOT EXISTS participant_user_id ON participant (user_id);
+CREATE INDEX IF NOT EXISTS title_pool_id_is_used ON title (pool_id, is_used);
+CREATE INDEX IF NOT EXISTS title_participant_id ON title (participant_id);
+CREATE INDEX IF NOT EXISTS round_challenge_id_finish_time ON round (challenge_id, finish_time);
+CREATE INDEX IF NOT EXISTS roll_participant_id ON roll (participant_id);
+CREATE INDEX IF NOT EXISTS roll_title_id ON roll (title_id);
@@ -0,0 +1,42 @@
+CREATE TABLE guild_user_stats (
+	guild_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	given_sum REAL NOT NULL DEFAULT 0,
+	given_count INTEGER NOT NULL DEFAULT 0,
+	received_sum REAL NOT NULL DEFAULT 0,
+	received_count INTEGER NOT NULL DEFAULT 0,
+	num_challenges INTEGER NOT NULL DEFAULT 0,
+	num_completed INTEGER NOT NULL DEFAULT 0,
+
+	PRIMARY KEY (guild_id, user_id),
+	FOREIGN KEY (guild_id) REFERENCES guild (id),
+	FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE TABLE guild_pair_stats (
+	guild_id INTEGER NOT NULL,
+	watcher_id INTEGER NOT NULL,
+	proposer_id INTEGER NOT NULL,
+	count INTEGER NOT NULL DEFAULT 0,
+
+	PRIMARY KEY (guild_id, watcher_id, proposer_id),
+	FOREIGN KEY (guild_id) REFERENCES guild (id),
+	FOREIGN KEY (watcher_id) REFERENCES user (id),
+	FOREIGN KEY (proposer_id) REFERENCES user (id)
+);
+
+CREATE INDEX guild_pair_stats_guild_id_count ON guild_pair_stats (guild_id, count DESC);
+
+-- Rounds and challenges already folded into the tables above. Everything finished and not listed here
+-- is applied by the next stats update, so existing history is backfilled by the first one.
+CREATE TABLE guild_stats_round (
+	round_id INTEGER NOT NULL PRIMARY KEY,
+
+	FOREIGN KEY (round_id) REFERENCES round (id)
+);
+
+CREATE TABLE guild_stats_challenge (
+	challenge_id INTEGER NOT NULL PRIMARY KEY,
+
+	FOREIGN KEY (challenge_id) REFERENCES challenge (id)
+);
@@ -0,0 +1,12 @@
+CREATE TABLE title_info (
+	provider TEXT NOT NULL,
+	external_id TEXT NOT NULL,
+	name TEXT DEFAULT NULL,
+	score REAL DEFAULT NULL,
+	length INTEGER DEFAULT NULL,
+	complexity INTEGER DEFAULT NULL,
+	error TEXT DEFAULT NULL,
+	fetch_time TIMESTAMP NOT NULL,
+
+	PRIMARY KEY (provider, external_id)
+);
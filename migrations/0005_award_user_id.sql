@@ -0,0 +1,18 @@
+-- Databases created before this series have award.participant_id, although awards were always written by user id.
+-- The table is rebuilt by column position so both shapes end up with user_id. Rows pointing to no user are dropped
+-- before the deferred foreign key check at COMMIT.
+PRAGMA defer_foreign_keys = ON;
+
+CREATE TABLE award_new (
+	user_id INTEGER NOT NULL,
+	"url" TEXT DEFAULT NULL,
+	"time" TIMESTAMP NOT NULL,
+	FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+INSERT INTO award_new SELECT * FROM award;
+DELETE FROM award_new WHERE user_id NOT IN (SELECT id FROM user);
+DROP TABLE award;
+ALTER TABLE award_new RENAME TO award;
+
+CREATE INDEX award_user_id ON award (user_id);
@@ -0,0 +1,34 @@
+class StateCache:
+    '''
+    Write-through cache of command context: guild -> current challenge -> last round -> participants by discord id,
+    plus users by discord id. Cached relations are updated in place by the commands that change them, anything
+    else that changes this state must invalidate the guild.
+    '''
+    def __init__(self):
+        self.guilds = {}
+        self.users = {}
+        self.hits = 0
+        self.misses = 0
+
+    def guild_entry(self, guild_id):
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = { 'participants': {} }
+        return self.guilds[guild_id]
+
+    async def lookup(self, entries, key, fetch):
+        if key in entries:
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        value = await fetch()
+        # a command may have cached and updated its own copy while this fetch was running, that one is newer
+        return entries.setdefault(key, value)
+
+    def invalidate(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def invalidate_participants(self, guild_id):
+        self.guild_entry(guild_id)['participants'] = {}
+
+    def invalidate_user(self, discord_id):
+        self.users.pop(discord_id, None)
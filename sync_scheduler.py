@@ -0,0 +1,45 @@
+import asyncio
+import traceback
+
+class SyncScheduler:
+    '''
+    Coalesces export requests per (spreadsheet, challenge) within a delay window and runs at most one export
+    per spreadsheet at a time.
+    '''
+    def __init__(self, export, delay):
+        self.export = export
+        self.delay = delay
+        self.pending = {}
+        self.locks = {}
+
+    def lock(self, spreadsheet_key):
+        if spreadsheet_key not in self.locks:
+            self.locks[spreadsheet_key] = asyncio.Lock()
+        return self.locks[spreadsheet_key]
+
+    def schedule(self, spreadsheet_key, challenge_id):
+        key = (spreadsheet_key, challenge_id)
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.run_delayed(key))
+
+    async def run_delayed(self, key):
+        await asyncio.sleep(self.delay)
+        # changes made from now on schedule another export
+        del self.pending[key]
+        try:
+            async with self.lock(key[0]):
+                await self.export(*key)
+        except Exception as e:
+            print(f'Sync of challenge {key[1]} failed:')
+            traceback.print_tb(e.__traceback__)
+            print(f'{e.__class__.__name__}: {e}')
+
+    def cancel(self, spreadsheet_key, challenge_id):
+        task = self.pending.pop((spreadsheet_key, challenge_id), None)
+        if task is not None:
+            task.cancel()
+
+    async def flush(self, spreadsheet_key, challenge_id, **kwargs):
+        self.cancel(spreadsheet_key, challenge_id)
+        async with self.lock(spreadsheet_key):
+            await self.export(spreadsheet_key, challenge_id, **kwargs)
@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+
+from aiohttp import web
+from thirdparty_api.http_client import HttpClient, HttpError
+
+async def serve(handler, client):
+    '''Runs handler on a local server and awaits client(base_url, http_client).'''
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    http_client = HttpClient(timeout=0.5, max_retries=2)
+    try:
+        return await client(f'http://{host}:{port}', http_client)
+    finally:
+        await http_client.close()
+        await runner.cleanup()
+
+def test_retries_unavailable():
+    statuses = [503, 200]
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        return web.json_response({ 'ok': True }, status=statuses[len(requests) - 1])
+
+    result = asyncio.run(serve(handler, lambda url, client: client.get_json(f'{url}/title')))
+    assert result == { 'ok': True }
+    assert requests == ['/title', '/title']
+
+def test_raises_on_not_found():
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        return web.Response(status=404)
+
+    with pytest.raises(HttpError) as e:
+        asyncio.run(serve(handler, lambda url, client: client.get_text(f'{url}/missing')))
+    assert e.value.status == 404
+    assert len(requests) == 1
+
+def test_times_out():
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        await asyncio.sleep(1)
+        return web.Response(text='late')
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(serve(handler, lambda url, client: client.get_text(f'{url}/slow')))
+    assert len(requests) == 2
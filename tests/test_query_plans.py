@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+from datetime import datetime, timedelta
+from db import connect, Db, Guild, User, Participant, KarmaHistory, TitleInfo, GuildStats, UserStats, update_many
+from migrate import migrate
+
+INIT_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'init.sql')
+
+async def open_db(path):
+    connection = await connect(path, {})
+    with open(INIT_SQL, 'r') as f:
+        await connection.executescript(f.read())
+    await migrate(connection)
+    return Db(connection, check_query_plans=True)
+
+async def run_queries(db):
+    now = datetime.now()
+    guild = await Guild.fetch_or_insert(db, 1)
+    challenge = await guild.add_challenge('c', now)
+    await challenge.add_pool('main')
+    guild.current_challenge_id = challenge.id
+    await guild.update()
+    u1 = await User.fetch_or_insert(db, 10, 'a')
+    u2 = await User.fetch_or_insert(db, 11, 'b')
+    p1 = await challenge.add_participant(u1.id)
+    p2 = await challenge.add_participant(u2.id)
+    await challenge.has_participant(u1.id)
+    await challenge.fetch_participant(u1.id)
+    await challenge.fetch_participants()
+    await challenge.fetch_users_participants()
+
+    pool = await challenge.fetch_pool('main')
+    await challenge.has_pool('main')
+    await challenge.fetch_pools()
+    t1 = await pool.add_title(p1.id, 'x')
+    await pool.add_titles(p2.id, [('y', None), ('z', 'http://z')])
+    t2 = await pool.fetch_title('y')
+    await pool.fetch_titles()
+    await pool.fetch_unused_titles()
+    await challenge.has_title('x')
+    await challenge.fetch_title('x')
+    await challenge.fetch_titles()
+    await challenge.fetch_title_names()
+    await (await pool.fetch_title('z')).delete()
+
+    await challenge.has_started()
+    r = await challenge.add_round(0, now, now + timedelta(days=1))
+    await r.add_rolls([(p1.id, t1.id), (p2.id, t2.id)])
+    t1.is_used = t2.is_used = True
+    await update_many([t1, t2])
+    await challenge.fetch_last_round()
+    await challenge.fetch_round(0)
+    await challenge.fetch_rounds()
+    roll1 = await r.fetch_roll(p1.id)
+    roll2 = await r.fetch_roll(p2.id)
+    roll1.score = 7
+    roll2.score = 3
+    await roll1.update()
+    await roll2.update()
+    await roll1.fetch_title()
+    await roll1.fetch_participant()
+    await roll1.fetch_title_author()
+    await r.fetch_rolls()
+    await r.fetch_rolls_watchers_proposers()
+    r.is_finished = True
+    await r.update()
+    await Participant.fail_participants(db, r.id, [])
+    await challenge.fetch_snapshot()
+    await challenge.set_award('http://award')
+
+    await guild.has_challenge('c')
+    await guild.fetch_challenges()
+    await guild.fetch_users()
+    await guild.fetch_karma_rolls()
+    await guild.fetch_karma_rolls(now)
+    user_ids = [u1.id, u2.id]
+    await KarmaHistory.set_users_karma(db, { u1.id: 5, u2.id: 3 }, r.finish_time)
+    await KarmaHistory.fetch_users_karma(db, user_ids, now)
+    await KarmaHistory.clear_guild_karma_history(db, guild.id, r.finish_time)
+    await KarmaHistory.insert_karma_many(db, [(u1.id, 5, r.finish_time), (u2.id, 3, r.finish_time)])
+    await KarmaHistory.fetch_user_karma(db, u1.id)
+    await KarmaHistory.fetch_karma_history(db, u1.id)
+    await KarmaHistory.fetch_karma_version(db, user_ids)
+    await KarmaHistory.fetch_karma_histories(db, user_ids)
+    await guild.fetch_users_karma()
+
+    await u1.add_award('http://x', now)
+    await u1.remove_award('http://x')
+    await TitleInfo.store(db, ['myanimelist', '1', 'x', 8.0, 24, 10, None, now])
+    await TitleInfo.fetch(db, 'myanimelist', '1')
+    await TitleInfo.store_many(db, [['myanimelist', '2', 'y', None, None, None, 'Not found', now]])
+    await GuildStats.update(db, guild.id)
+    for kind in GuildStats.LEADERBOARDS:
+        await GuildStats.fetch_leaderboard(db, guild.id, kind)
+    await UserStats.fetch(db, u1.id, guild.id)
+
+    await challenge.add_pool('other')
+    await (await challenge.fetch_pool('other')).delete()
+    await p2.delete()
+
+def test_no_full_scans(tmp_path):
+    async def run():
+        db = await open_db(str(tmp_path / 'challenges.db'))
+        try:
+            await run_queries(db)
+        finally:
+            await db.close()
+        return db
+    db = asyncio.run(run())
+    assert len(db.checked_queries) > 50
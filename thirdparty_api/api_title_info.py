@@ -1,4 +1,3 @@
-import requests
 import re
 
 import thirdparty_api.kinopoisk_api as kinopoisk_api
@@ -12,19 +11,29 @@ class ApiTitleInfo:
         self.complexity = complexity
 
     @staticmethod
-    def from_url(url, config):
+    def provider_id(url):
+        '''
+        Returns a normalized (provider, id) pair identifying the title, or None for unsupported urls.
+        '''
+        for provider, api in (('kinopoisk', kinopoisk_api), ('myanimelist', mal_api)):
+            id = api.get_id_from_url(url)
+            if id is not None:
+                return provider, id
+        return None
+
+    @staticmethod
+    async def from_url(url, config):
         score = None
         name = None
-        print(re.search(r'kinopoisk', url))
         if re.search(r'kinopoisk', url):
-            json = kinopoisk_api.get_film_data(url, config['kinopoisk_api_token'])
+            json = await kinopoisk_api.get_film_data(url, config['kinopoisk_api_token'])
             name = json['data']['nameEn']
             score = json['rating']['rating']
             length = kinopoisk_api.length_to_minutes(json['data']['filmLength'])
             complexity = kinopoisk_api.calc_complexity(score, length)
             return ApiTitleInfo(name, score, length, complexity)
         elif re.search(r'myanimelist', url):
-            data = mal_api.get_anime_data(url)
+            data = await mal_api.get_anime_data(url)
             name = data['name']
             score = data['score']
             num_of_episodes = data['num_of_episodes']
@@ -0,0 +1,61 @@
+import aiohttp
+import asyncio
+import random
+
+from metrics import metrics
+from urllib.parse import urlsplit
+
+TIMEOUT = 15
+PER_HOST_LIMIT = 4
+MAX_RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class HttpError(Exception):
+    def __init__(self, url, status):
+        super().__init__(f'{url} responded with status {status}.')
+        self.url = url
+        self.status = status
+
+class HttpClient:
+    '''
+    Shared keep-alive session for third party apis. Concurrency is capped per host by the connector.
+    '''
+    def __init__(self, timeout=TIMEOUT, per_host_limit=PER_HOST_LIMIT, max_retries=MAX_RETRIES):
+        self.timeout = timeout
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.per_host_limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def get(self, url, headers=None, as_json=False):
+        for attempt in range(self.max_retries):
+            last_attempt = attempt == self.max_retries - 1
+            try:
+                with metrics.timer('external_seconds', service='http', host=urlsplit(url).hostname):
+                    async with self.get_session().get(url, headers=headers) as response:
+                        if response.status == 200:
+                            return await response.json(content_type=None) if as_json else await response.text()
+                        if response.status not in RETRY_STATUSES or last_attempt:
+                            raise HttpError(url, response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            await asyncio.sleep(0.5 * 2 ** attempt + random.random() * 0.5)
+
+    async def get_text(self, url, headers=None):
+        return await self.get(url, headers)
+
+    async def get_json(self, url, headers=None):
+        return await self.get(url, headers, as_json=True)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+client = HttpClient()
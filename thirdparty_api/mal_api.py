@@ -1,39 +1,83 @@
-import requests as r
+import html as html_lib
+import json
 import re
 
+from thirdparty_api.http_client import client
+
+def get_id_from_url(url):
+    m = re.search(r'myanimelist\.net/anime/(\d+)', url)
+    return None if m is None else m[1]
+
+MINS_RE = re.compile(r'(\d+) min')
+HRS_RE = re.compile(r'(\d+) hr')
+OG_TITLE_RE = re.compile(r'<meta property="og:title" content="([^"]*)"')
+TITLE_RE = re.compile(r'<title>\s*([^<]*?)\s*(?:- MyAnimeList\.net\s*)?</title>')
+LD_JSON_RE = re.compile(r'<script type="application/ld\+json">(.*?)</script>', flags=re.DOTALL)
+SIDEBAR_FIELD_RE = re.compile(r'<span class="dark_text">([^<:]+):</span>(.*?)</div>', flags=re.DOTALL)
+TAG_RE = re.compile(r'<[^>]*>')
+NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+# assumed episode length when the page has no usable duration, as the original parser did
+DEFAULT_LENGTH = 20
+
 def length_str_to_minutes(s):
     mins = 0
-    mins_parsed = re.search(r'(\d+)? min', s, flags=re.DOTALL)
+    mins_parsed = MINS_RE.search(s)
     if mins_parsed:
         mins += int(mins_parsed[1])
-    hrs_parsed = re.search(r'(\d+)? hr', s, flags=re.DOTALL)
-
+    hrs_parsed = HRS_RE.search(s)
     if hrs_parsed:
         mins += 60*int(hrs_parsed[1])
     return mins
 
 def calc_complexity(score, num_of_episodes, length):
+    if score is None or num_of_episodes is None or length is None:
+        return None
     MAX_TIME = 26*25 # 26 episodes 25 mins each
     time_spent = num_of_episodes * length
     hardness_to_watch = (max(1, min(9 - score, 8)) - 1) / 7
     complexity = hardness_to_watch * (time_spent / MAX_TIME) * 100
     return int(complexity)
 
+def parse_number(s, type):
+    m = None if s is None else NUMBER_RE.match(str(s).strip())
+    return None if m is None else type(m[0])
+
+def region(html, begin, end):
+    i = html.find(begin)
+    if i == -1:
+        return ''
+    j = html.find(end, i)
+    return html[i:] if j == -1 else html[i:j]
+
+def parse_ld_json(head):
+    for m in LD_JSON_RE.finditer(head):
+        try:
+            data = json.loads(m[1])
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return data
+    return {}
+
 def mal_parser(html):
-    name=re.search(r'\<meta property=\"og:title\" content=\"(.*?)\"\>', html)[1]
-    score=re.search(r'.*?score\-label.*?\>(\d+?\.\d+?)\<.*?', html)[1]
-    num_of_episodes=re.search(r'pisodes\:</span>.*?(\d+).*?\<', html, flags=re.DOTALL)[1]
-    length_str=re.search(r'Duration\:</span>.*?\"(.*?)\".*?\<', html, flags=re.DOTALL)[1]
-    length = length_str_to_minutes(length_str)
-    if length == 0:
-        length = 20 # todo: decide if it's ok to do it like that? maybe should handle it differently
-    return {'name': name, 'score': float(score), 'num_of_episodes': int(num_of_episodes), 'length' : length}
-
-def get_anime_data(url):
-    response = r.get(url)
-    if response.status_code == 200:
-        html=response.text
-        return mal_parser(html)
-    else:
-        raise "Bad myanimelist api status code recieved"
+    '''
+    Extracts title metadata from the <head> and the left sidebar of an anime page, never the whole document.
+    Missing fields come back as None and a missing duration as DEFAULT_LENGTH; only a missing name is an error.
+    '''
+    head = region(html, '', '</head>')
+    ld = parse_ld_json(head)
+    sidebar = {key.strip(): ' '.join(TAG_RE.sub(' ', value).split())
+        for key, value in SIDEBAR_FIELD_RE.findall(region(html, 'class="leftside"', 'class="rightside"'))}
+
+    m = OG_TITLE_RE.search(head) or TITLE_RE.search(head)
+    name = html_lib.unescape(m[1]) if m else ld.get('name')
+    if not name:
+        raise ValueError('No title name found on the page.')
+    rating = ld.get('aggregateRating')
+    score = parse_number(isinstance(rating, dict) and rating.get('ratingValue') or sidebar.get('Score'), float)
+    num_of_episodes = parse_number(ld.get('numberOfEpisodes') or sidebar.get('Episodes'), int)
+    length = length_str_to_minutes(sidebar.get('Duration', '')) or DEFAULT_LENGTH
+    return {'name': name, 'score': score, 'num_of_episodes': num_of_episodes, 'length': length}
 
+async def get_anime_data(url):
+    return mal_parser(await client.get_text(url))
@@ -1,5 +1,4 @@
 import re
-import random
 
 def is_vaild_url(url):
     regex = re.compile(
@@ -11,7 +10,3 @@ def is_vaild_url(url):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
         
     return re.match(regex, url) is not None
-
-# todo: make better fname generation
-def gen_fname(prefix=''):
-    return f'{int(random.random()*10000)}{prefix}'
\ No newline at end of file